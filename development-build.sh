@@ -24,53 +24,33 @@ set -eux
 VERSION="1.9.16"
 RELEASE=""
 
-mkdir -p "repository/raw/macosx-wine-development"
-repo_path="repository/raw/macosx-wine-development/$VERSION$RELEASE-x86"
-[ -d "$repo_path" ] && rmdir --ignore-fail-on-non-empty "$repo_path"
-if mkdir "$repo_path"; then
-	./server/build.py --machine "debian-stretch-x64" \
-		--dependencies "repository/raw/macosx-toolchain-2.0.0/deps" \
-		"temp/macosx-wine-development" "$repo_path"
-fi
+matrix="$(mktemp)"
+trap 'rm -f "$matrix"' EXIT
+
+echo "debian-stretch-x64 temp/macosx-wine-development" \
+	"repository/raw/macosx-wine-development/$VERSION$RELEASE-x86" \
+	"repository/raw/macosx-toolchain-2.0.0/deps" >> "$matrix"
 
 for codename in stretch wheezy jessie sid; do
-	mkdir -p "repository/raw/debian-$codename-development"
 	for arch in x86 x64; do
-
-		repo_path="repository/raw/debian-$codename-development/$VERSION$RELEASE-$arch"
-		[ -d "$repo_path" ] && rmdir --ignore-fail-on-non-empty "$repo_path"
-		if mkdir "$repo_path"; then
-			./server/build.py --machine "debian-$codename-$arch" \
-				"temp/debian-$codename-development" "$repo_path"
-		fi
-
+		echo "debian-$codename-$arch temp/debian-$codename-development" \
+			"repository/raw/debian-$codename-development/$VERSION$RELEASE-$arch" >> "$matrix"
 	done
 done
 
 for codename in 5 4; do
-	mkdir -p "repository/raw/mageia-$codename-development"
 	for arch in x86 x64; do
-
-		repo_path="repository/raw/mageia-$codename-development/$VERSION$RELEASE-$arch"
-		[ -d "$repo_path" ] && rmdir --ignore-fail-on-non-empty "$repo_path"
-		if mkdir "$repo_path"; then
-			./server/build.py --machine "mageia$codename-$arch" \
-				"temp/mageia-any-development" "$repo_path"
-		fi
-
+		echo "mageia$codename-$arch temp/mageia-any-development" \
+			"repository/raw/mageia-$codename-development/$VERSION$RELEASE-$arch" >> "$matrix"
 	done
 done
 
 for codename in 22 23 24; do
-	mkdir -p "repository/raw/fedora-$codename-development"
 	for arch in x86 x64; do
-
-		repo_path="repository/raw/fedora-$codename-development/$VERSION$RELEASE-$arch"
-		[ -d "$repo_path" ] && rmdir --ignore-fail-on-non-empty "$repo_path"
-		if mkdir "$repo_path"; then
-			./server/build.py --machine "fedora-$codename-$arch" \
-				"temp/fedora-any-development" "$repo_path"
-		fi
-
+		echo "fedora-$codename-$arch temp/fedora-any-development" \
+			"repository/raw/fedora-$codename-development/$VERSION$RELEASE-$arch" >> "$matrix"
 	done
 done
+
+# Run all builds concurrently, already populated destinations are skipped
+./server/build.py matrix --incremental "$matrix"
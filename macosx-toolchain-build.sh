@@ -34,7 +34,7 @@ for tool in clang llvm-defaults bomutils cctools cctools64 xar; do
 	if mkdir "$repo_path"; then
 		./server/build.py --machine "debian-stretch-x64" --dependencies "$deps_path" \
 		"temp/macosx-$tool-native" "$repo_path"
-		cp -a "$repo_path"/*.deb "$deps_path"
+		ln -f "$repo_path"/*.deb "$deps_path"
 	fi
 done
 
@@ -46,7 +46,7 @@ for package in libjpeg-turbo liblzma libtiff liblcms2 libxml2 libxslt libopenal-
 	if mkdir "$repo_path"; then
 		./server/build.py --machine "debian-stretch-x64" --dependencies "$deps_path" \
 		"temp/macosx-$package" "$repo_path"
-		cp -a "$repo_path"/*-osx.tar.gz "$deps_path"
-		cp -a "$repo_path"/*-osx64.tar.gz "$deps_path"
+		ln -f "$repo_path"/*-osx.tar.gz "$deps_path"
+		ln -f "$repo_path"/*-osx64.tar.gz "$deps_path"
 	fi
 done
@@ -21,32 +21,47 @@
 #
 
 from lxml import etree
+import BaseHTTPServer
+import SocketServer
 import argparse
+import contextlib
+import copy
 import datetime
+import errno
+import fcntl
 import grp
 import guestfs
+import hashlib
+import json
 import libvirt
 import os
+import posixpath
 import random
 import re
+import select
 import shutil
+import socket
 import stat
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
 import time
+import traceback
+import urllib2
+import urlparse
 import uuid
 
 BUILDER_SETTINGS = {
     # Debian Wheezy
     "debian-wheezy-x86": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
     "debian-wheezy-x64": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
@@ -54,13 +69,11 @@ BUILDER_SETTINGS = {
     # Debian Jessie
     "debian-jessie-x86": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
     "debian-jessie-x64": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
@@ -68,13 +81,11 @@ BUILDER_SETTINGS = {
     # Debian Stretch
     "debian-stretch-x86": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
     "debian-stretch-x64": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
@@ -82,13 +93,11 @@ BUILDER_SETTINGS = {
     # Debian Sid
     "debian-sid-x86": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
     "debian-sid-x64": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
@@ -96,13 +105,11 @@ BUILDER_SETTINGS = {
     # Archlinux
     "arch-x86": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
     "arch-x64": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
@@ -110,13 +117,11 @@ BUILDER_SETTINGS = {
     # Mageia 4
     "mageia4-x86": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "build",
         "build_group":  "build",
     },
     "mageia4-x64": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "build",
         "build_group":  "build",
     },
@@ -124,13 +129,11 @@ BUILDER_SETTINGS = {
     # Mageia 5
     "mageia5-x86": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "build",
         "build_group":  "build",
     },
     "mageia5-x64": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "build",
         "build_group":  "build",
     },
@@ -138,13 +141,11 @@ BUILDER_SETTINGS = {
     # Fedora 22
     "fedora-22-x86": {
         'partition': "/dev/fedora/root",
-        'log_tty'  : "/dev/ttyS0",
         'build_user':   "builder",
         "build_group":  "builder",
     },
     "fedora-22-x64": {
         'partition': "/dev/fedora/root",
-        'log_tty'  : "/dev/ttyS0",
         'build_user':   "builder",
         "build_group":  "builder",
     },
@@ -152,13 +153,11 @@ BUILDER_SETTINGS = {
     # Fedora 23
     "fedora-23-x86": {
         'partition': "/dev/fedora/root",
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
     "fedora-23-x64": {
         'partition': "/dev/fedora/root",
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
@@ -166,13 +165,11 @@ BUILDER_SETTINGS = {
     # Fedora 24
     "fedora-24-x86": {
         'partition': "/dev/fedora/root",
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
     "fedora-24-x64": {
         'partition': "/dev/fedora/root",
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
@@ -180,18 +177,106 @@ BUILDER_SETTINGS = {
     # XUbuntu 14.04 with graphical environment
     "xubuntu-14.04-x86-gui": {
         'partition': 0,
-        'log_tty'  : "/dev/ttyS1",
         'build_user':   "builder",
         "build_group":  "builder",
     },
 }
 
+# Defaults for settings which are not specified per machine
+BUILDER_DEFAULTS = {
+    'ready_timeout':    300,    # Maximum time the guest waits for the network, 0 to skip
+    'package_cache':    True,   # Download distro packages through a caching proxy
+    'profile':          "default", # Performance profile from BUILDER_PROFILES
+    'scratch':          None,   # Directory for job roots (e.g. tmpfs or NVMe), None for server/jobs
+    'scratch_disk':     None,   # Expected scratch usage in GiB, None for the worst case
+    'cluster_size':     "256K", # Cluster size of the qcow2 overlays
+    'preallocation':    None,   # "metadata" to preallocate overlays, needs qemu >= 5.0
+    'ccache':           8,      # Size of the persistent compiler cache in GiB, 0 to disable
+    'build_tree':       32,     # Size of the build tree for incremental builds in GiB
+}
+
+# Performance profiles applied to the cloned domain, None keeps the value of the original VM
+BUILDER_PROFILES = {
+    "default": {
+        'vcpus':        None,       # Number of virtual CPUs
+        'memory':       None,       # Memory in MiB
+        'cpuset':       None,       # Pin vCPUs to a set of host cores, e.g. "0-3,8-11"
+        'disk_cache':   "unsafe",   # Overlays are thrown away, no need for crash-safe caching
+        'disk_io':      None,       # "native" requires disk_cache "none" or "directsync"
+        'disk_queues':  None,       # Number of virtio-blk queues
+    },
+    "compile": {
+        'vcpus':        4,
+        'memory':       4096,
+        'disk_queues':  4,
+    },
+}
+
 BUILDER_ROOT = os.path.dirname(os.path.realpath(__file__))
 assert os.path.isfile(os.path.join(BUILDER_ROOT, "buildjob.service"))
 assert os.path.isfile(os.path.join(BUILDER_ROOT, "rc.local"))
 assert os.path.isfile(os.path.join(BUILDER_ROOT, "wrapper.sh"))
 assert os.path.isdir(os.path.join(BUILDER_ROOT, "./jobs"))
 
+BUILDER_JOBS    = os.path.join(BUILDER_ROOT, "./jobs")
+BUILDER_LAYERS  = os.path.join(BUILDER_ROOT, "./layers")
+BUILDER_CCACHE  = os.path.join(BUILDER_ROOT, "./ccache")
+BUILDER_CCACHE_LABEL = "buildcache" # Filesystem label, wrapper.sh mounts the cache by label
+BUILDER_CCACHE_EXPIRE = 14      # Days until compiler caches of unused toolchains are removed
+BUILDER_TREES   = os.path.join(BUILDER_ROOT, "./trees")
+BUILDER_TREE_LABEL = "buildtree" # Filesystem label, wrapper.sh mounts the build tree by label
+BUILDER_PACKAGES = os.path.join(BUILDER_ROOT, "./packages")
+BUILDER_LAYER_MANIFEST = "depends.sh" # Script in the source directory to install dependencies
+BUILDER_LAYER_EXPIRE = 14       # Days until unused dependency layers are removed
+
+BUILDER_STORE   = os.path.join(os.path.dirname(BUILDER_ROOT), "repository/blobs")
+BUILDER_CACHE   = os.path.join(os.path.dirname(BUILDER_ROOT), "repository/cache")
+
+BUILDER_COMPRESS        = None  # Compression for bulk transfers, "gzip" or "bzip2"
+BUILDER_CONTENT_MAX     = 1024 * 1024   # Larger payloads go through temporary files
+BUILDER_RELEASE_TIMEOUT = 60    # Maximum time until qemu releases a disk image
+BUILDER_WAIT_POLL       = 60    # Fallback state check if lifecycle events are lost
+BUILDER_WAIT_TIMEOUT    = None  # Maximum time to wait for a VM shutdown, None to wait forever
+BUILDER_LIBVIRT_URI     = "qemu:///system"
+BUILDER_LIBVIRT_CONFIG  = "/etc/libvirt/qemu" # Definitions of the original VMs, for the XML cache
+
+# Python 2 tarfile only streams gzip and bzip2, both tables offer the same options
+TAR_COMPRESS_FLAGS = {
+    "gzip":     "-z",
+    "bzip2":    "-j",
+}
+
+TAR_STREAM_MODES = {
+    None:       "r|",
+    "gzip":     "r|gz",
+    "bzip2":    "r|bz2",
+}
+
+def machine_settings(machine):
+    """ Get the settings of a machine, including defaults. """
+    settings = dict(BUILDER_DEFAULTS)
+    settings.update(BUILDER_SETTINGS[machine])
+    return settings
+
+def machine_profile(settings):
+    """ Get the performance profile of a machine, including defaults. """
+    profile = dict(BUILDER_PROFILES["default"])
+    profile.update(BUILDER_PROFILES[settings['profile']])
+    if profile['disk_io'] == "native" and profile['disk_cache'] not in ["none", "directsync"]:
+        raise RuntimeError("Profile %s: io=native requires disk_cache none or directsync" % settings['profile'])
+    return profile
+
+def scratch_root(settings):
+    """ Get the directory for job roots of a machine. """
+    if settings['scratch'] is None:
+        return os.path.realpath(BUILDER_JOBS)
+    return os.path.realpath(settings['scratch'])
+
+def scratch_free(path):
+    """ Get the free space of a scratch directory in bytes. """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
 def try_mkdir_p(path):
     try:
         os.makedirs(path)
@@ -202,25 +287,801 @@ def try_mkdir_p(path):
             raise
     return True
 
+def set_cloexec(fd):
+    """ Do not leak fd into subprocesses, other jobs start them concurrently. """
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fd
+
+def fsync_dir(path):
+    """ Make renames in a directory durable. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def last_use(paths):
+    """ Latest mtime of the paths which still exist, None if all of them were removed. """
+    result = None
+    for path in paths:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        result = max(result, mtime)
+    return result
+
+def xml_memory(xml_memory):
+    """ Convert a libvirt memory element to KiB. """
+    units = { 'b': 1, 'bytes': 1,
+              'kb': 1000, 'k': 1024, 'kib': 1024,
+              'mb': 1000**2, 'm': 1024**2, 'mib': 1024**2,
+              'gb': 1000**3, 'g': 1024**3, 'gib': 1024**3,
+              'tb': 1000**4, 't': 1024**4, 'tib': 1024**4 }
+    unit = xml_memory.get("unit", "KiB").lower()
+    return int(xml_memory.text) * units[unit] // 1024
+
+def domain_xml(original):
+    """ Get the parsed XML definition of an original VM. """
+    return hypervisor().domain_xml(original)
+
+def domain_resources(tree, settings=None):
+    """ Determine vCPUs, memory (KiB) and scratch disk usage (bytes) of a domain. """
+    vcpus  = int(tree.xpath("/domain/vcpu")[0].text)
+    memory = xml_memory(tree.xpath("/domain/memory")[0])
+
+    if settings is not None and settings['scratch_disk'] is not None:
+        return { 'vcpus': vcpus, 'memory': memory, 'disk': settings['scratch_disk'] * 1024**3 }
+
+    # Overlays can grow up to the virtual size of the backing image
+    disk = 0
+    for xml_disk in tree.xpath("/domain/devices/disk[@device='disk']/source"):
+        info = json.loads(subprocess.check_output(["qemu-img", "info", "--output=json",
+                                                   xml_disk.get("file")]))
+        disk += info["virtual-size"]
+
+    return { 'vcpus': vcpus, 'memory': memory, 'disk': disk }
+
+def apply_profile(tree, profile):
+    """ Apply a performance profile to the parsed XML definition of a VM. """
+    if profile['vcpus'] is not None or profile['cpuset'] is not None:
+        xml_vcpu = tree.xpath("/domain/vcpu")[0]
+        if profile['vcpus'] is not None:
+            xml_vcpu.text = str(profile['vcpus'])
+            if "current" in xml_vcpu.attrib:
+                del xml_vcpu.attrib["current"]
+            for xml_topology in tree.xpath("/domain/cpu/topology"):
+                xml_topology.getparent().remove(xml_topology)
+        if profile['cpuset'] is not None:
+            xml_vcpu.set("placement", "static")
+            xml_vcpu.set("cpuset", profile['cpuset'])
+
+    if profile['memory'] is not None:
+        for xml_memory in tree.xpath("/domain/memory | /domain/currentMemory"):
+            xml_memory.set("unit", "KiB")
+            xml_memory.text = str(profile['memory'] * 1024)
+
+    for xml_disk in tree.xpath("/domain/devices/disk[@device='disk']"):
+        xml_driver = xml_disk.find("driver")
+        if xml_driver is None:
+            xml_driver = etree.SubElement(xml_disk, "driver", name="qemu", type="qcow2")
+        if profile['disk_cache'] is not None:
+            xml_driver.set("cache", profile['disk_cache'])
+        if profile['disk_io'] is not None:
+            xml_driver.set("io", profile['disk_io'])
+        if profile['disk_queues'] is not None and xml_disk.xpath("target[@bus='virtio']"):
+            xml_driver.set("queues", str(profile['disk_queues']))
+
+def wait_image_released(path, timeout=BUILDER_RELEASE_TIMEOUT):
+    """ Wait until no other process holds a lock on a disk image. """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        start = time.time()
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as exc:
+                if exc.errno not in [errno.EACCES, errno.EAGAIN]:
+                    raise
+                if time.time() - start > timeout:
+                    raise RuntimeError("Disk image %s is still in use" % path)
+                time.sleep(0.01)
+            else:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+                return time.time() - start
+    finally:
+        os.close(fd)
+
+def hash_file(fp, dest=None, size=None):
+    """ Compute SHA256 and MD5 of a file object in a single pass, optionally copy it.
+        If size is given, at most size bytes are read. """
+    sha256, md5 = hashlib.sha256(), hashlib.md5()
+    while size is None or size > 0:
+        data = fp.read(1024 * 1024 if size is None else min(size, 1024 * 1024))
+        if data == "":
+            break
+        if size is not None:
+            size -= len(data)
+        sha256.update(data)
+        md5.update(data)
+        if dest is not None:
+            dest.write(data)
+    return sha256.hexdigest(), md5.hexdigest()
+
+def checksum_line(digest, filename):
+    """ Format a line exactly like sha256sum / md5sum. """
+    if "\\" in filename or "\n" in filename:
+        filename = filename.replace("\\", "\\\\").replace("\n", "\\n")
+        return "\\%s  %s\n" % (digest, filename)
+    return "%s  %s\n" % (digest, filename)
+
+def extract_tar_stream(fileobj, local_path, compress=None):
+    """ Extract a tar stream, returns SHA256 and MD5 of all regular files. """
+    digests = {}
+    tar = tarfile.open(fileobj=fileobj, mode=TAR_STREAM_MODES[compress])
+    try:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if name == ".":
+                continue
+            if name.startswith("..") or os.path.isabs(name):
+                raise RuntimeError("Refusing to extract %s" % member.name)
+            target = os.path.join(local_path, name)
+
+            if member.isdir():
+                if try_mkdir_p(target):
+                    os.chmod(target, member.mode)
+
+            elif member.isfile():
+                assert not os.path.exists(target)
+                with open(target, "wb") as fp:
+                    digests[name] = hash_file(tar.extractfile(member), fp)
+                os.chmod(target, member.mode)
+
+            elif member.issym():
+                os.symlink(member.linkname, target)
+
+    finally:
+        tar.close()
+
+    # Consume the padding, the writer would fail otherwise
+    while fileobj.read(65536) != "":
+        pass
+
+    return digests
+
+def tree_size(path):
+    """ Count files and bytes below a local directory. """
+    files, size = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            files += 1
+            size  += os.lstat(os.path.join(dirpath, f)).st_size
+    return files, size
+
+def link_file(src, dst):
+    """ Hardlink a file, falls back to a reflink or copy across file systems. """
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        subprocess.check_call(["cp", "--reflink=auto", "--", src, dst])
+
+class BlobStore(object):
+    def __init__(self, root=BUILDER_STORE):
+        """ Content-addressed storage for build artifacts, keyed by SHA256. """
+        self.root = os.path.abspath(root)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def add(self, path, sha256):
+        """ Add a file to the store, afterwards it is a link to the blob. """
+        blob = self.blob_path(sha256)
+        try_mkdir_p(os.path.dirname(blob))
+
+        # gc() relies on the link count, a copy of the file would be deleted
+        try:
+            os.link(path, blob)
+            return blob
+        except OSError as exc:
+            if exc.errno == errno.EXDEV:
+                raise RuntimeError("Blob store %s is not on the same file system as %s" % (self.root, path))
+            if exc.errno != errno.EEXIST:
+                raise
+
+        # Same content is already stored, replace the file with a link
+        if os.path.samefile(path, blob):
+            return blob
+        temp = "%s.tmp-%d" % (path, os.getpid())
+        os.link(blob, temp)
+        os.rename(temp, path)
+        return blob
+
+    def usable(self, path):
+        """ Check if files in path can be linked into the store. """
+        try_mkdir_p(self.root)
+        return os.stat(self.root).st_dev == os.stat(path).st_dev
+
+    def gc(self, dry_run=False):
+        """ Delete all blobs which are not linked from anywhere else. """
+        removed, size = 0, 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for f in filenames:
+                st = os.lstat(os.path.join(dirpath, f))
+                if st.st_nlink > 1:
+                    continue
+                if not dry_run:
+                    os.unlink(os.path.join(dirpath, f))
+                removed += 1
+                size    += st.st_size
+        return removed, size
+
+def hash_tree(digest, path):
+    """ Add names, modes and contents of a local directory to a hash object. """
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for f in sorted(filenames):
+            filename = os.path.join(dirpath, f)
+            st = os.lstat(filename)
+            digest.update("%s\0%o\0" % (os.path.relpath(filename, path), st.st_mode))
+            if stat.S_ISLNK(st.st_mode):
+                digest.update(os.readlink(filename))
+            else:
+                with open(filename, "rb") as fp:
+                    digest.update(hash_file(fp)[0])
+
+def disk_identity(machine):
+    """ Path, mtime and size of the base images, they are too large to hash. """
+    result = []
+    for xml_disk in domain_xml(machine).xpath("/domain/devices/disk[@device='disk']/source"):
+        st = os.stat(xml_disk.get("file"))
+        result.append((xml_disk.get("file"), st.st_mtime, st.st_size))
+    return result
+
+def toolchain_key(images):
+    """ Identify the toolchain of a job by the disk images it is based on. """
+    digest = hashlib.sha256()
+    for path in images:
+        st = os.stat(path)
+        digest.update("disk\0%s\0%d\0%d\0" % (path, st.st_mtime, st.st_size))
+    return digest.hexdigest()
+
+def build_digest(machine, source, dependencies=None):
+    """ Compute a digest of everything which influences the result of a build. """
+    digest = hashlib.sha256()
+    digest.update("machine\0%s\0" % machine)
+    digest.update("settings\0%s\0" % json.dumps(machine_settings(machine), sort_keys=True))
+
+    for identity in disk_identity(machine):
+        digest.update("disk\0%s\0%d\0%d\0" % identity)
+
+    for f in ["wrapper.sh", "buildjob.service", "rc.local"]:
+        with open(os.path.join(BUILDER_ROOT, f), "rb") as fp:
+            digest.update("%s\0%s\0" % (f, hash_file(fp)[0]))
+
+    digest.update("source\0")
+    hash_tree(digest, source)
+    if dependencies is not None:
+        digest.update("dependencies\0")
+        hash_tree(digest, dependencies)
+
+    return digest.hexdigest()
+
+class BuildCache(object):
+    def __init__(self, root=BUILDER_CACHE):
+        """ Results of successful builds, keyed by build_digest. """
+        self.root = os.path.abspath(root)
+
+    def restore(self, digest, destination):
+        """ Link a cached result into destination, returns False if there is none. """
+        entry = os.path.join(self.root, digest)
+        if not os.path.isdir(entry):
+            return False
+
+        # Entries are expired by the time of their last use
+        try:
+            os.utime(entry, None)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return False
+
+        for f in os.listdir(entry):
+            link_file(os.path.join(entry, f), os.path.join(destination, f))
+        return True
+
+    def save(self, digest, destination):
+        """ Remember the result of a successful build. """
+        try_mkdir_p(self.root)
+        temp = tempfile.mkdtemp(prefix="%s-" % digest, dir=self.root)
+        try:
+            for f in os.listdir(destination):
+                link_file(os.path.join(destination, f), os.path.join(temp, f))
+            os.rename(temp, os.path.join(self.root, digest))
+        except OSError as exc:
+            shutil.rmtree(temp)
+            if exc.errno not in [errno.EEXIST, errno.ENOTEMPTY]:
+                raise
+
+    def expire(self, max_age, dry_run=False):
+        """ Delete cached results which were not used for max_age seconds. """
+        removed = 0
+        if os.path.isdir(self.root):
+            for f in os.listdir(self.root):
+                entry = os.path.join(self.root, f)
+                mtime = last_use([entry])
+                if mtime is not None and time.time() - mtime > max_age:
+                    if not dry_run:
+                        shutil.rmtree(entry)
+                    removed += 1
+        return removed
+
+PACKAGE_PATTERN = re.compile("\\.(deb|udeb|rpm|drpm|pkg\\.tar\\.(xz|gz|zst))$")
+
+class PackageCache(object):
+    def __init__(self, root):
+        """ Cache for immutable package files, shared by all machines of a distro family. """
+        self.root   = os.path.abspath(root)
+        self.lock   = threading.Lock()
+        self.stats  = { 'hits': 0, 'hit_bytes': 0, 'misses': 0, 'miss_bytes': 0, 'uncached': 0 }
+        try_mkdir_p(self.root)
+
+    def path(self, url):
+        """ Get the cache location for an URL, None if it shouldn't be cached. """
+        path = urlparse.urlparse(url).path
+        if not PACKAGE_PATTERN.search(path):
+            return None
+        return os.path.join(self.root, "%s-%s" % (hashlib.sha256(url).hexdigest()[:16],
+                                                  posixpath.basename(path)))
+
+    def count(self, kind, size=0):
+        with self.lock:
+            if kind == "hit":
+                self.stats['hits']       += 1
+                self.stats['hit_bytes']  += size
+            elif kind == "miss":
+                self.stats['misses']     += 1
+                self.stats['miss_bytes'] += size
+            else:
+                self.stats['uncached']   += 1
+
+def network_address(network):
+    """ Get the host address of a libvirt network. """
+    addresses = hypervisor().network_xml(network).xpath("/network/ip[not(@family) or @family='ipv4']/@address")
+    return addresses[0] if len(addresses) else None
+
+class JobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/ready":
+            self.server.job._guest_ready()
+            self._reply(200, "ready\n")
+        elif self.path.startswith("http://") and self.server.packages is not None:
+            self._proxy(self.server.packages)
+        else:
+            self.send_error(404)
+
+    def _proxy(self, cache):
+        """ Forward a request, package files are served from the cache if possible. """
+        filename = cache.path(self.path)
+        if filename is not None and os.path.isfile(filename):
+            with open(filename, "rb") as fp:
+                size = os.fstat(fp.fileno()).st_size
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                shutil.copyfileobj(fp, self.wfile)
+            cache.count("hit", size)
+            return
+
+        request = urllib2.Request(self.path)
+        headers = ["If-Modified-Since", "If-None-Match"]
+        if filename is None:
+            headers.append("Range")
+        for header in headers:
+            if self.headers.getheader(header) is not None:
+                request.add_header(header, self.headers.getheader(header))
+
+        try:
+            response = urllib2.urlopen(request, timeout=60)
+        except urllib2.HTTPError as exc:
+            response = exc
+        except (urllib2.URLError, socket.error) as exc:
+            self.send_error(502, str(exc))
+            return
+
+        try:
+            code = response.getcode()
+            self.send_response(code)
+            for header in ["Content-Type", "Content-Length", "Content-Range", "Last-Modified", "ETag"]:
+                if response.info().getheader(header) is not None:
+                    self.send_header(header, response.info().getheader(header))
+            self.end_headers()
+
+            # Store complete downloads under a temporary name first
+            temp = None
+            if filename is not None and code == 200:
+                temp = tempfile.NamedTemporaryFile(prefix=".download-", dir=cache.root, delete=False)
+
+            size, cached = 0, False
+            try:
+                while True:
+                    data = response.read(65536)
+                    if data == "":
+                        break
+                    self.wfile.write(data)
+                    if temp is not None:
+                        temp.write(data)
+                    size += len(data)
+
+                # httplib returns an empty read when the upstream closes early,
+                # only a download with the announced length may end up in the cache
+                length = response.info().getheader("Content-Length")
+                if temp is not None and length is not None and int(length) == size:
+                    temp.close()
+                    os.rename(temp.name, filename)
+                    temp, cached = None, True
+                elif temp is not None:
+                    self.server.job._log_to_file("Not caching %s, got %d of %s bytes" % (self.path, size, length))
+            finally:
+                if temp is not None:
+                    temp.close()
+                    os.unlink(temp.name)
+
+            cache.count("miss" if cached else "uncached", size)
+
+        finally:
+            response.close()
+
+    def _reply(self, code, content):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+class JobServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, job, address, packages=None):
+        """ HTTP server for the guest of a build job, reachable on the libvirt network. """
+        BaseHTTPServer.HTTPServer.__init__(self, (address, 0), JobRequestHandler)
+        self.job        = job
+        self.packages   = packages  # PackageCache, None to disable the proxy
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path):
+        return "http://%s:%d%s" % (self.server_address[0], self.server_address[1], path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
 def randomMAC():
     mac = [ 0x00, 0x16, 0x3e, random.randint(0x00, 0x7f),
             random.randint(0x00, 0xff), random.randint(0x00, 0xff) ]
     return ':'.join(map(lambda x: "%02x" % x, mac))
 
+_timestamp = (None, None)
+
+def log_timestamp():
+    """ Get the current time for log messages, only formatted once per second. """
+    global _timestamp
+    now = int(time.time())
+    if _timestamp[0] != now:
+        _timestamp = (now, time.strftime('%H:%M:%S', time.gmtime(now)))
+    return _timestamp[1]
+
+class LogPump(object):
+    def __init__(self):
+        """ Forward the VM output of all build jobs using a single epoll loop. """
+
+        self.epoll      = select.epoll()
+        self.lock       = threading.Lock()
+        self.streams    = {}        # fd -> (job, buffer, finished event)
+
+        thread = threading.Thread(target=self._run_loop)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, fd, job):
+        """ Forward lines from a non-blocking fd to the log of a job until EOF. """
+        finished = threading.Event()
+        with self.lock:
+            self.streams[fd] = (job, bytearray(), finished)
+        self.epoll.register(fd, select.EPOLLIN)
+        return finished
+
+    def remove(self, fd):
+        """ Stop forwarding and close the fd. """
+        with self.lock:
+            stream = self.streams.pop(fd, None)
+        if stream is None:
+            return
+        job, buf, finished = stream
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError):
+            pass
+        os.close(fd)
+        finished.set()
+
+    def _run_loop(self):
+        while True:
+            try:
+                events = self.epoll.poll()
+            except IOError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+
+            for fd, mask in events:
+                with self.lock:
+                    stream = self.streams.get(fd)
+                if stream is None:
+                    continue
+
+                # A failing stream must not take down the output of all other jobs
+                try:
+                    self._handle(fd, stream)
+                except:
+                    traceback.print_exc()
+                    try:
+                        stream[0]._log_to_file("Forwarding VM output failed, closing the stream")
+                    except:
+                        pass
+                    self.remove(fd)
+
+    def _handle(self, fd, stream):
+        job, buf, finished = stream
+
+        try:
+            data = os.read(fd, 65536)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return
+            raise
+
+        if data == "":
+            if len(buf):
+                job._forward_lines([str(buf)])
+            self.remove(fd)
+            return
+
+        # Only complete lines are written, the rest stays in the buffer
+        buf.extend(data)
+        end = buf.rfind("\n")
+        if end >= 0:
+            lines = str(buf[:end]).split("\n")
+            del buf[:end + 1]
+            job._forward_lines(lines)
+
+_log_pump      = None
+_log_pump_lock = threading.Lock()
+
+def log_pump():
+    """ Get the LogPump shared by all build jobs. """
+    global _log_pump
+    with _log_pump_lock:
+        if _log_pump is None:
+            _log_pump = LogPump()
+        return _log_pump
+
+class Hypervisor(object):
+    def __init__(self, conn=None, uri=BUILDER_LIBVIRT_URI):
+        """ Libvirt connection shared by all build jobs, tests can pass a fake connection. """
+
+        self.uri        = uri
+        self.conn       = conn
+        self.lock       = threading.Lock()
+        self.xml_cache  = {}        # Original VM -> (mtime of definition, parsed XML)
+        self.events     = []        # Registered (event id, callback), restored after reconnecting
+
+        if conn is None:
+            # The event loop also answers keepalive requests, it has to run even if no job waits
+            libvirt.virEventRegisterDefaultImpl()
+            thread = threading.Thread(target=self._run_loop)
+            thread.daemon = True
+            thread.start()
+            self._connection()
+
+    def _run_loop(self):
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    def _closed(self, conn, reason, opaque):
+        """ Called by libvirt when the connection was closed, reopened on the next use. """
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+
+    def _connection(self):
+        """ Get the connection, reopen it if libvirt closed it. """
+        with self.lock:
+            if self.conn is None:
+                self.conn = libvirt.open(self.uri)
+                self.conn.registerCloseCallback(self._closed, None)
+                for event_id, callback in self.events:
+                    self.conn.domainEventRegisterAny(None, event_id, callback, None)
+            return self.conn
+
+    def register_event(self, event_id, callback):
+        """ Register a callback for domain events of all domains. """
+        conn = self._connection()
+        with self.lock:
+            self.events.append((event_id, callback))
+        conn.domainEventRegisterAny(None, event_id, callback, None)
+
+    def domain_xml(self, original):
+        """ Get the parsed XML definition of a domain, cached until the definition changes. """
+        try:
+            mtime = os.path.getmtime(os.path.join(BUILDER_LIBVIRT_CONFIG, "%s.xml" % original))
+        except OSError:
+            mtime = None
+
+        with self.lock:
+            cached = self.xml_cache.get(original)
+        if mtime is None or cached is None or cached[0] != mtime:
+            cached = (mtime, etree.fromstring(self._connection().lookupByName(original).XMLDesc(0)))
+            if mtime is not None:
+                with self.lock:
+                    self.xml_cache[original] = cached
+
+        # Callers modify the tree
+        return copy.deepcopy(cached[1])
+
+    def network_xml(self, network):
+        """ Get the parsed XML definition of a network. """
+        return etree.fromstring(self._connection().networkLookupByName(network).XMLDesc(0))
+
+    def define(self, xml):
+        """ Define a persistent domain, returns its name. """
+        return self._connection().defineXML(xml).name()
+
+    def start(self, domain):
+        self._connection().lookupByName(domain).create()
+
+    def destroy(self, domain):
+        """ Forcefully stop a domain, returns False if it was not running. """
+        try:
+            self._connection().lookupByName(domain).destroy()
+        except libvirt.libvirtError:
+            return False
+        return True
+
+    def undefine(self, domain):
+        self._connection().lookupByName(domain).undefine()
+
+    def state(self, domain):
+        """ Get the state of a domain, None if it does not exist. """
+        try:
+            return self._connection().lookupByName(domain).info()[0]
+        except (libvirt.libvirtError, TypeError, IndexError):
+            return None
+
+_hypervisor      = None
+_hypervisor_lock = threading.Lock()
+
+def hypervisor():
+    """ Get the Hypervisor shared by all build jobs. """
+    global _hypervisor
+    with _hypervisor_lock:
+        if _hypervisor is None:
+            _hypervisor = Hypervisor()
+        return _hypervisor
+
+def set_hypervisor(hv):
+    """ Replace the Hypervisor shared by all build jobs, tests pass one with a fake
+        connection. None opens the libvirt connection again on the next use. """
+    global _hypervisor, _domain_watcher
+    with _hypervisor_lock:
+        _hypervisor = hv
+    with _domain_watcher_lock:
+        _domain_watcher = None
+
+class DomainWatcher(object):
+    def __init__(self, hypervisor):
+        """ Watch lifecycle events of all domains using a single event loop. """
+
+        self.hypervisor = hypervisor
+        self.lock       = threading.Lock()
+        self.watched    = {}        # Domain name -> threading.Event
+
+        # Events are dispatched by the event loop of the hypervisor connection
+        hypervisor.register_event(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._lifecycle)
+
+    def _lifecycle(self, conn, dom, event, detail, opaque):
+        if event in [libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                     libvirt.VIR_DOMAIN_EVENT_SHUTDOWN,
+                     libvirt.VIR_DOMAIN_EVENT_CRASHED,
+                     libvirt.VIR_DOMAIN_EVENT_UNDEFINED]:
+            with self.lock:
+                stopped = self.watched.get(dom.name())
+            if stopped is not None:
+                stopped.set()
+
+    def _is_dead(self, domain):
+        state = self.hypervisor.state(domain)
+        return state in [None,
+                         libvirt.VIR_DOMAIN_SHUTDOWN,
+                         libvirt.VIR_DOMAIN_SHUTOFF,
+                         libvirt.VIR_DOMAIN_CRASHED]
+
+    def wait(self, domain, timeout=None, poll=BUILDER_WAIT_POLL):
+        """ Wait until a domain is shut down, returns False on timeout. """
+
+        stopped = threading.Event()
+        with self.lock:
+            assert not self.watched.has_key(domain)
+            self.watched[domain] = stopped
+
+        try:
+            # Registered before the first check, so no event can be missed
+            start = time.time()
+            while not self._is_dead(domain):
+                delay = poll
+                if timeout is not None:
+                    delay = min(delay, start + timeout - time.time())
+                    if delay <= 0:
+                        return False
+                if stopped.wait(delay):
+                    break
+            return True
+
+        finally:
+            with self.lock:
+                del self.watched[domain]
+
+_domain_watcher      = None
+_domain_watcher_lock = threading.Lock()
+
+def domain_watcher():
+    """ Get the DomainWatcher shared by all build jobs. """
+    global _domain_watcher
+    with _domain_watcher_lock:
+        if _domain_watcher is None:
+            _domain_watcher = DomainWatcher(hypervisor())
+        return _domain_watcher
+
 class BuildJob(object):
-    def __init__(self, original):
-        """ Create a new build job. """
+    def __init__(self, original, backing=None, ccache=False, project=None, persistent=False):
+        """ Create a new build job, optionally on top of other backing images
+            and with the persistent compiler cache of the machine and the build
+            tree of the project attached. Disks of a persistent job are kept. """
 
+        self.machine        = original  # Name of the original VM
         self.root           = None      # build directory
         self.log            = None      # Handle to build.log file
-        self.vm_log_path    = None      # Serial port log, used for build log
+        self.events         = None      # Handle to events.jsonl file
+        self.vm_output      = None      # Time of the first output from the VM
+        self.vm_status      = None      # Exit status reported by the VM
+        self.vm_heartbeat   = None      # Time of the last heartbeat from the VM
+        self.channel_path   = None      # Socket of the virtio-serial channel
+        self.export_path    = None      # Socket of the artifact channel
+        self.artifacts      = {}        # Artifacts received while the VM was running
         self.disks          = []        # Disk information
+        self.ccache         = None      # Compiler cache image if attached
+        self.build_tree     = None      # "clean" or "incremental" if a build tree is attached
+        self.build_tree_key = None      # Project and toolchain of the build tree
+        self.build_tree_stamp = None    # Stamp file written after a successful build
+        self.image_locks    = []        # Locks on attached persistent disk images
         self.domain         = None      # Domain
         self.settings       = None      # Various settings
         self.guestfs        = None      # GuestFs if started, else None
+        self.network        = None      # Host address on the libvirt network
+        self.server         = None      # JobServer if started, else None
+        self.vm_started     = None      # Time when the VM was started
+        self.vm_ready       = None      # Time when the guest network was ready
 
         try:
-            self._initialize(original)
+            self._initialize(original, backing, ccache, project, persistent)
         except:
             self._destroy()
             raise
@@ -230,11 +1091,65 @@ class BuildJob(object):
 
     def _log_to_file(self, message):
         """ Writes a message to the log. """
+        self._log_lines([message])
+
+    def _log_lines(self, lines):
+        """ Writes multiple messages to the log at once. """
         if self.log is not None:
-            message = "[%s] %s" % (datetime.datetime.utcnow().strftime('%H:%M:%S'), message)
-            self.log.write("%s\n" % (message,))
-            self.log.flush()
-            print message
+            prefix = "[%s] " % log_timestamp()
+            data = "%s%s\n" % (prefix, ("\n%s" % prefix).join(lines))
+            self.log.write(data)
+            sys.stdout.write(data)
+
+    def _forward_lines(self, lines):
+        """ Handles messages from the VM, see send_message in wrapper.sh. """
+        if self.vm_output is None:
+            self.vm_output = time.time()
+
+        log = []
+        for line in lines:
+            kind, _, payload = line.partition(" ")
+            try:
+                if kind == "L":
+                    log.append(payload)
+                elif kind == "S":
+                    self.vm_status = int(payload)
+                elif kind == "P":
+                    log.append("*** %s ***" % payload)
+                elif kind == "H":
+                    self.vm_heartbeat = time.time()
+                elif kind == "E":
+                    phase, start, end = payload.split()
+                    self._event(phase, float(start), float(end), source="guest")
+                else:
+                    log.append(line)
+            except ValueError:
+                # Keep malformed frames in the log instead of dropping the batch
+                log.append("*** Malformed message: %r ***" % line)
+
+        if len(log):
+            self._log_lines(log)
+
+    def _event(self, phase, start, end, **info):
+        """ Writes a timing event to events.jsonl. """
+        if self.events is not None:
+            event = { 'job': os.path.basename(self.root), 'machine': self.machine,
+                      'phase': phase, 'start': start, 'end': end, 'duration': end - start }
+            event.update(info)
+            self.events.write("%s\n" % json.dumps(event, sort_keys=True))
+
+    @contextlib.contextmanager
+    def _phase(self, phase):
+        """ Time a phase of the build job, the yielded dict takes additional counters. """
+        info = {}
+        start = time.time()
+        try:
+            yield info
+        except:
+            info['failed'] = True
+            raise
+        finally:
+            self._event(phase, start, time.time(), **info)
 
     def _check_call(self, cmd, *args, **kwds):
         """ Call external process. """
@@ -255,9 +1170,10 @@ class BuildJob(object):
     def _start_guestfs(self):
         """ Start guestfs for direct disk access. """
         if self.guestfs is None:
-            self.guestfs = guestfs.GuestFS()
-            self.guestfs.add_drive_opts(self.disks[0], format='qcow2', readonly=0)
-            self.guestfs.launch()
+            with self._phase("guestfs-launch"):
+                self.guestfs = guestfs.GuestFS()
+                self.guestfs.add_drive_opts(self.disks[0], format='qcow2', readonly=0)
+                self.guestfs.launch()
 
             partition = self.settings['partition']
             if isinstance(partition, int):
@@ -267,7 +1183,24 @@ class BuildJob(object):
                 partition_name = partition
             self.guestfs.mount_options("", partition_name, "/")
 
-    def _initialize(self, original):
+    def _stop_guestfs(self):
+        """ Flush and shut down guestfs, wait until the disks are released. """
+        if self.guestfs is not None:
+            start = time.time()
+            with self._phase("guestfs-shutdown") as info:
+                try:
+                    self.guestfs.sync()
+                    self.guestfs.umount_all()
+                    self.guestfs.shutdown()
+                finally:
+                    self.guestfs.close()
+                    self.guestfs = None
+
+                # Newer qemu versions lock the image files, make sure they are gone
+                info['release'] = sum(wait_image_released(disk) for disk in self.disks)
+            self._log_to_file("Guestfs shut down after %.3fs" % (time.time() - start))
+
+    def _initialize(self, original, backing, ccache, project, persistent):
         """ Used in the constructor, initialize build job. """
 
         # Short path - if its not a whitelisted VM then abort immediately
@@ -275,7 +1208,7 @@ class BuildJob(object):
             raise RuntimeError("Original VM is not in the whitelist.")
 
         # Load settings, this contains the partition number and other information
-        self.settings = BUILDER_SETTINGS[original]
+        self.settings = machine_settings(original)
 
         # Get group of libvirtd
         try:
@@ -285,22 +1218,31 @@ class BuildJob(object):
         gid_libvirt = group.gr_gid
 
         # Create root directory
-        self.root = tempfile.mkdtemp(prefix="build-", dir=os.path.join(BUILDER_ROOT, "./jobs"))
+        scratch = scratch_root(self.settings)
+        try_mkdir_p(scratch)
+        self.root = tempfile.mkdtemp(prefix="build-", dir=scratch)
         os.chown(self.root, -1, gid_libvirt)
         os.chmod(self.root, 0775)
 
         # Open log file
         self.log = open(os.path.join(self.root, "build.log"), "ab", buffering=0)
         os.fchmod(self.log.fileno(), 0644) # no need to give it to libvirt
+        self.events = open(os.path.join(self.root, "events.jsonl"), "ab", buffering=0)
+        os.fchmod(self.events.fileno(), 0644)
         self._log_to_file("Build started at %s" % datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
         self._log_to_file("Cloning VM %s for build job %s" % (original, self.root))
 
         # Get information from original VM, create new domain name
-        xml  = subprocess.check_output(["virsh", "dumpxml", "--domain", original])
-        tree = etree.fromstring(xml)
+        tree = domain_xml(original)
         domain = "%s-%s" % (os.path.basename(self.root), original)
         assert domain.startswith("build-")
 
+        # Apply the performance profile before anything else touches the disks
+        profile = machine_profile(self.settings)
+        if persistent and profile['disk_cache'] == "unsafe":
+            profile['disk_cache'] = "writeback"
+        apply_profile(tree, profile)
+
         # Update name / uuid / mac
         xml_name = tree.xpath("/domain/name")[0]
         xml_name.text = domain
@@ -308,29 +1250,57 @@ class BuildJob(object):
         xml_uuid.text = str(uuid.uuid1())
         xml_mac = tree.xpath("/domain/devices/interface[@type='network']/mac")[0]
         xml_mac.set('address', randomMAC())
+        xml_network = tree.xpath("/domain/devices/interface[@type='network']/source")[0]
+        self.network = network_address(xml_network.get("network"))
+
+        # The virtual size is only an upper bound, admission is up to the scheduler
+        needed, available = domain_resources(tree, self.settings)['disk'], scratch_free(self.root)
+        if needed > available:
+            self._log_to_file("WARNING: Overlays in %s may grow to %d MiB but only %d MiB are available" %
+                              (scratch, needed // 1024**2, available // 1024**2))
+
+        options = ["cluster_size=%s" % self.settings["cluster_size"]]
+        if self.settings["preallocation"] is not None:
+            options.append("preallocation=%s" % self.settings["preallocation"])
+
+        # Images this job is based on, they also identify the toolchain
+        images = [xml_disk.get("file") if backing is None else backing[i] for i, xml_disk in
+                  enumerate(tree.xpath("/domain/devices/disk[@device='disk']/source"))]
 
         # Clone disks
-        for i, xml_disk in enumerate(tree.xpath("/domain/devices/disk[@device='disk']/source")):
-            if not xml_disk.get("file").endswith(".qcow2"):
-                raise RuntimeError("Wrong disk file format, only qcow2 is supported.")
-            disk_path = os.path.abspath(os.path.join(self.root, "disk%d.qcow2" % i))
-            self._check_call(["qemu-img", "create", "-f", "qcow2", "-b", xml_disk.get("file"), disk_path])
-            os.chown(disk_path, -1, gid_libvirt)
-            os.chmod(disk_path, 0660) # disk image should be protected
-            xml_disk.set("file", disk_path)
-            self.disks.append(disk_path)
+        with self._phase("clone") as info:
+            for i, xml_disk in enumerate(tree.xpath("/domain/devices/disk[@device='disk']/source")):
+                backing_file = images[i]
+                if not backing_file.endswith(".qcow2"):
+                    raise RuntimeError("Wrong disk file format, only qcow2 is supported.")
+                disk_path = os.path.abspath(os.path.join(self.root, "disk%d.qcow2" % i))
+                self._check_call(["qemu-img", "create", "-f", "qcow2", "-o", ",".join(options),
+                                  "-b", backing_file, disk_path])
+                os.chown(disk_path, -1, gid_libvirt)
+                os.chmod(disk_path, 0660) # disk image should be protected
+                xml_disk.set("file", disk_path)
+                self.disks.append(disk_path)
+            info['files'] = len(self.disks)
         assert len(self.disks) > 0
 
-        # Define a serial port for the log - undocumented,
-        # but based on the qemu source this works. ;)
-        self.vm_log_path = os.path.abspath(os.path.join(self.root, "vm_log"))
-        os.mkfifo("%s.out" % self.vm_log_path)
-        os.chown("%s.out" % self.vm_log_path, -1, gid_libvirt)
-        os.chmod("%s.out" % self.vm_log_path, 0660)
-        os.symlink("/dev/null", "%s.in" % self.vm_log_path)
-        xml_serial = etree.SubElement(tree.xpath("/domain/devices")[0], "serial", type="pipe")
-        etree.SubElement(xml_serial, "source", path=self.vm_log_path)
-        etree.SubElement(xml_serial, "target", port="1")
+        if ccache and self.settings["ccache"] > 0:
+            self._attach_ccache(tree, toolchain_key(images), gid_libvirt)
+
+        if project is not None:
+            self._attach_build_tree(tree, project, toolchain_key(images), gid_libvirt)
+
+        # Define a virtio-serial channel for messages from wrapper.sh,
+        # the socket is created by qemu when the VM starts
+        self.channel_path = os.path.abspath(os.path.join(self.root, "channel.sock"))
+        xml_channel = etree.SubElement(tree.xpath("/domain/devices")[0], "channel", type="unix")
+        etree.SubElement(xml_channel, "source", mode="bind", path=self.channel_path)
+        etree.SubElement(xml_channel, "target", type="virtio", name="org.winehq.build.0")
+
+        # Second channel to stream artifacts from export.sh
+        self.export_path = os.path.abspath(os.path.join(self.root, "export.sock"))
+        xml_channel = etree.SubElement(tree.xpath("/domain/devices")[0], "channel", type="unix")
+        etree.SubElement(xml_channel, "source", mode="bind", path=self.export_path)
+        etree.SubElement(xml_channel, "target", type="virtio", name="org.winehq.build.1")
 
         # Audio support
         if original.endswith("-gui"):
@@ -339,78 +1309,246 @@ class BuildJob(object):
             xml_qemu = etree.SubElement(tree.xpath("/domain")[0], "{%s}commandline" % qemu_namespace)
             etree.SubElement(xml_qemu, "{%s}env" % qemu_namespace, name="QEMU_AUDIO_DRV", value="none")
 
-        # Define new VM based on modified XML file
+        # Define new VM based on modified XML file, the file is kept for debugging
         xml_path = os.path.join(self.root, "definition.xml")
         with open(xml_path, "wb") as fp:
             fp.write(etree.tostring(tree, pretty_print=True))
         os.chown(xml_path, -1, gid_libvirt)
         os.chmod(xml_path, 0664)
-        self._check_call(["virsh", "define", xml_path])
-        self.domain = domain
+        self._log_to_file("Defining domain %s" % domain)
+        self.domain = hypervisor().define(etree.tostring(tree))
 
         self._log_to_file("Initialized build job %s" % self.root)
 
+    def _lock_image(self, path):
+        """ Lock a persistent disk image for this job, returns False if another job uses it. """
+        lock = open("%s.lock" % path, "ab")
+        set_cloexec(lock.fileno())
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exc:
+            lock.close()
+            if exc.errno not in [errno.EACCES, errno.EAGAIN]:
+                raise
+            return False
+        self.image_locks.append(lock)
+        os.utime("%s.lock" % path, None) # Last use, for expiry
+        return True
+
+    def _create_image(self, path, size, label, gid_libvirt):
+        """ Create a persistent disk image with an empty ext4 filesystem. """
+        g = guestfs.GuestFS()
+        try:
+            g.disk_create("%s.tmp" % path, "qcow2", size * 1024**3)
+            g.add_drive_opts("%s.tmp" % path, format='qcow2', readonly=0)
+            g.launch()
+            g.mkfs("ext4", "/dev/sda", label=label)
+            g.shutdown()
+        finally:
+            g.close()
+
+        os.chown("%s.tmp" % path, -1, gid_libvirt)
+        os.chmod("%s.tmp" % path, 0660)
+        os.rename("%s.tmp" % path, path)
+
+    def _attach_image(self, tree, path):
+        """ Attach a persistent disk image as an additional virtio disk. """
+        targets = set(xml_target.get("dev") for xml_target in tree.xpath("/domain/devices/disk/target"))
+        target = next("vd%s" % c for c in "bcdefghijklmnopqrstuvwxyz" if "vd%s" % c not in targets)
+
+        xml_disk = etree.SubElement(tree.xpath("/domain/devices")[0], "disk", type="file", device="disk")
+        etree.SubElement(xml_disk, "driver", name="qemu", type="qcow2", cache="writeback")
+        etree.SubElement(xml_disk, "source", file=path)
+        etree.SubElement(xml_disk, "target", dev=target, bus="virtio")
+
+    def _attach_ccache(self, tree, key, gid_libvirt):
+        """ Attach the compiler cache of this machine and toolchain as an additional disk. """
+        try_mkdir_p(BUILDER_CCACHE)
+        path = os.path.abspath(os.path.join(BUILDER_CCACHE, "%s-%s.qcow2" % (self.machine, key)))
+
+        # A cache image is never shared between concurrent jobs
+        if not self._lock_image(path):
+            self._log_to_file("Compiler cache %s is in use, building without cache" % path)
+            return
+
+        if not os.path.isfile(path):
+            with self._phase("ccache-create"):
+                self._expire_ccache(path)
+                self._create_image(path, self.settings["ccache"], BUILDER_CCACHE_LABEL, gid_libvirt)
+
+        self._attach_image(tree, path)
+        self.ccache = path
+        self._log_to_file("Using compiler cache %s" % path)
+
+    def _expire_ccache(self, path):
+        """ Remove compiler caches of toolchains which were not used for a while. """
+        outdated = re.compile("^%s-[0-9a-f]{64}\\.qcow2$" % re.escape(self.machine))
+        for f in os.listdir(BUILDER_CCACHE):
+            if not outdated.match(f) or os.path.join(BUILDER_CCACHE, f) == path:
+                continue
+            # The lock is touched on every use, caches created before locking have none
+            mtime = last_use([os.path.join(BUILDER_CCACHE, "%s.lock" % f)]) or \
+                    last_use([os.path.join(BUILDER_CCACHE, f)])
+            if mtime is None or time.time() - mtime < BUILDER_CCACHE_EXPIRE * 86400:
+                continue
+            with open(os.path.join(BUILDER_CCACHE, "%s.lock" % f), "ab") as lock:
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as exc:
+                    if exc.errno not in [errno.EACCES, errno.EAGAIN]:
+                        raise
+                    continue
+                # The lock file stays, another job may already have it open in _lock_image
+                if os.path.exists(os.path.join(BUILDER_CCACHE, f)):
+                    self._log_to_file("Removing unused compiler cache %s" % f)
+                    os.unlink(os.path.join(BUILDER_CCACHE, f))
+
+    def _attach_build_tree(self, tree, project, toolchain, gid_libvirt):
+        """ Attach the persistent build tree of this machine and project, a tree built
+            with a different toolchain or by an unfinished job is replaced by an empty one. """
+        try_mkdir_p(BUILDER_TREES)
+        path = os.path.abspath(os.path.join(BUILDER_TREES, "%s-%s.qcow2" % (self.machine, project)))
+        stamp = "%s.toolchain" % path
+        key = "%s %s" % (project, toolchain)
+
+        if not self._lock_image(path):
+            self._log_to_file("Build tree %s is in use, building from scratch" % path)
+            return
+
+        previous = None
+        if os.path.isfile(path) and os.path.isfile(stamp):
+            with open(stamp, "rb") as fp:
+                previous = fp.read().strip()
+
+        if previous == key:
+            self.build_tree = "incremental"
+            self._log_to_file("Using build tree %s from a previous build" % path)
+        else:
+            if previous is not None:
+                self._log_to_file("Toolchain changed, starting with a clean build tree")
+            with self._phase("tree-create"):
+                self._create_image(path, self.settings["build_tree"], BUILDER_TREE_LABEL, gid_libvirt)
+            self.build_tree = "clean"
+
+        # The stamp is only written back after a successful build
+        if os.path.isfile(stamp):
+            os.unlink(stamp)
+        self.build_tree_key = key
+        self.build_tree_stamp = stamp
+        self._attach_image(tree, path)
+
     def _destroy(self):
         """ Deinitialize build job """
 
         self._log_to_file("Deleting build job %s" % self.root)
         if self.domain is not None:  # Delete domain
-            self._call(["virsh", "destroy", self.domain])
-            self._check_call(["virsh", "undefine", self.domain])
+            hypervisor().destroy(self.domain)
+            hypervisor().undefine(self.domain)
             self.domain = None
+        if self.server is not None:  # Stop HTTP server
+            self.server.close()
+            self.server = None
         if self.guestfs is not None: # Unmount guestfs
             self.guestfs.close()
             self.guestfs = None
         if self.log is not None:     # Close log file if any
             self.log.close()
             self.log = None
+        if self.events is not None:  # Close events file if any
+            self.events.close()
+            self.events = None
+        for lock in self.image_locks: # Release persistent disk images
+            lock.close()
+        self.image_locks = []
         if self.root is not None:    # Delete root directory
             shutil.rmtree(self.root)
             self.root = None
         return True
 
-    def _forward_log(self):
-        """ Forward log from VM to log file """
-
-        if self.log is None:
-            return
+    def _guest_ready(self):
+        """ Called when the guest reports a working network. """
+        if self.vm_ready is None:
+            self.vm_ready = time.time()
+            self._log_to_file("Guest network is ready")
+            if self.vm_started is not None:
+                self._event("network-ready", self.vm_started, self.vm_ready)
 
-        fd = None
+    def _forward_log(self):
+        """ Forward messages from the VM, returns an event set on EOF """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            fd = os.open("%s.out" % self.vm_log_path, os.O_RDONLY)
-            data = ""
-            while True:
-                new_data = os.read(fd, 4096)
-                if new_data == "":
-                    self._log_to_file(data)
-                    return
-
-                data += new_data
-                lines = data.split("\n")
-                for line in lines[:-1]:
-                    self._log_to_file(line)
-                data = lines[-1]
-
+            sock.connect(self.channel_path)
+            sock.setblocking(0)
+            fd = set_cloexec(os.dup(sock.fileno()))
         finally:
-            if fd is not None:
-                os.close(fd)
+            sock.close()
+        return (fd, log_pump().add(fd, self))
 
-    def _wait(self):
-        """ Wait until a VM is really dead """
-        conn = None
+    def _receive_artifacts(self):
+        """ Receive artifacts streamed by export.sh, returns the receiving thread """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            conn = libvirt.open("qemu:///system")
-            while True:
-                time.sleep(10)
+            sock.connect(self.export_path)
+            set_cloexec(sock.fileno())
+            fp = sock.makefile("rb")
+        finally:
+            sock.close()
+
+        export_dir = os.path.join(self.root, "export")
+        try_mkdir_p(export_dir)
+
+        def _receive():
+            with contextlib.closing(fp):
                 try:
-                    state = conn.lookupByName(self.domain).info()[0]
-                except (libvirt.libvirtError, TypeError, IndexError):
-                    break
-                if state in [4, 5, 6]: # crashed or shutdown
+                    _receive_files()
+                except:
+                    thread.error = sys.exc_info()
+                    self._log_to_file("Receiving artifacts failed: %s" % thread.error[1])
+                    while fp.read(1024 * 1024) != "":
+                        pass # Guest blocks until everything was read
+
+        def _receive_files():
+            while True:
+                header = fp.readline()
+                if header == "":
                     break
-        finally:
-            if conn is not None:
-                conn.close()
+
+                m = re.match("^F ([0-9]+) ([0-7]+) ([^/\n]+)\n$", header)
+                if m is None or m.group(3) in [".", ".."]:
+                    raise RuntimeError("Invalid artifact header %r" % header)
+
+                size, mode, name = int(m.group(1)), int(m.group(2), 8), m.group(3)
+                start = time.time()
+                local_file = os.path.join(export_dir, name)
+                self.artifacts.pop(name, None)
+                try:
+                    with open(local_file, "wb") as dst:
+                        digests = hash_file(fp, dst, size)
+                    if os.path.getsize(local_file) != size:
+                        raise RuntimeError("Artifact %s was truncated" % name)
+                except:
+                    if os.path.exists(local_file):
+                        os.unlink(local_file)
+                    raise
+
+                os.chmod(local_file, mode)
+                self.artifacts[name] = (local_file, size, digests)
+                self._event("export", start, time.time(), files=1, bytes=size)
+                self._log_to_file("Received artifact %s (%d bytes)" % (name, size))
+
+        thread = threading.Thread(target=_receive)
+        thread.daemon = True
+        thread.error = None
+        thread.start()
+        return thread
+
+    def _wait(self, timeout=BUILDER_WAIT_TIMEOUT):
+        """ Wait until a VM is really dead """
+        start = time.time()
+        if domain_watcher().wait(self.domain, timeout):
+            self._log_to_file("VM shutdown detected after %.3fs" % (time.time() - start))
+        else:
+            self._log_to_file("Timeout while waiting for VM to shutdown")
 
     #
     # File system functions
@@ -469,6 +1607,9 @@ class BuildJob(object):
     def fs_upload_content(self, path, content):
         self._start_guestfs()
         self._log_to_file("Uploading %s into VM" % (path,))
+        if len(content) <= BUILDER_CONTENT_MAX:
+            return self.guestfs.write(path, content)
+
         fp = None
         try:
             fp = tempfile.NamedTemporaryFile(prefix="upload-", dir=self.root, delete=False)
@@ -496,6 +1637,30 @@ class BuildJob(object):
         permissions = os.stat(local_path)[stat.ST_MODE]
         self.fs_chmod(path, permissions)
 
+    def fs_upload_tree(self, path, local_path, compress=BUILDER_COMPRESS):
+        """ Upload a directory as a single tar stream, keeps file modes. """
+        self._start_guestfs()
+        self._log_to_file("Uploading %s into VM" % (path,))
+        assert os.path.isdir(local_path)
+
+        cmd = ["tar", "-c", "-f", "-", "--numeric-owner", "--owner=0", "--group=0", "-C", local_path]
+        kwds = {}
+        if compress is not None:
+            cmd.append(TAR_COMPRESS_FLAGS[compress])
+            kwds['compress'] = compress
+        cmd.append(".")
+
+        self.guestfs.mkdir_p(path)
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=True)
+        set_cloexec(process.stdout.fileno())
+        try:
+            self.guestfs.tar_in_opts("/dev/fd/%d" % process.stdout.fileno(), path, **kwds)
+        finally:
+            process.stdout.close()
+            retcode = process.wait()
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, cmd)
+
     def fs_download_file(self, path, local_path):
         self._start_guestfs()
         assert not os.path.exists(local_path)
@@ -503,6 +1668,9 @@ class BuildJob(object):
 
     def fs_download_content(self, path):
         self._start_guestfs()
+        if self.guestfs.filesize(path) <= BUILDER_CONTENT_MAX:
+            return self.guestfs.read_file(path)
+
         fp = None
         try:
             fp = tempfile.NamedTemporaryFile(prefix="download-", dir=self.root, delete=False)
@@ -527,27 +1695,90 @@ class BuildJob(object):
         else:
             raise NotImplementedError("Failed to download %s, neither a file nor directory" % path)
 
+    def fs_download_tree(self, path, local_path, excludes=None, compress=BUILDER_COMPRESS):
+        """ Download a directory as a single tar stream, keeps file modes.
+            Returns SHA256 and MD5 of all files, computed while downloading. """
+        self._start_guestfs()
+        assert os.path.isdir(local_path)
+
+        kwds = {}
+        if compress is not None:
+            kwds['compress'] = compress
+        if excludes:
+            kwds['excludes'] = excludes
+
+        # A subprocess holding the write end would keep the reader from seeing EOF
+        read_fd, write_fd = os.pipe()
+        set_cloexec(read_fd)
+        set_cloexec(write_fd)
+        result = {}
+
+        def _extract():
+            try:
+                with os.fdopen(read_fd, "rb") as fp:
+                    result['digests'] = extract_tar_stream(fp, local_path, compress)
+            except:
+                result['error'] = sys.exc_info()
+
+        thread = threading.Thread(target=_extract)
+        thread.start()
+        try:
+            self.guestfs.tar_out_opts(path, "/dev/fd/%d" % write_fd, **kwds)
+        finally:
+            os.close(write_fd)
+            thread.join()
+            if result.has_key('error'):
+                raise result['error'][0], result['error'][1], result['error'][2]
+
+        return result['digests']
+
     #
     # VM control functions
     #
 
     def run(self):
-        if self.guestfs:
-            self.guestfs.close()
-            self.guestfs = None
-            time.sleep(5) # make sure the guestfs mount is really gone
+        self._stop_guestfs()
+
+        with self._phase("vm"):
+            start = self.vm_started = time.time()
+            self._log_to_file("Starting domain %s" % self.domain)
+            hypervisor().start(self.domain)
+
+            # The guest blocks on writes until the host is connected
+            fd, finished = self._forward_log()
+            receiver = self._receive_artifacts()
+
+            # Use a timeout to stay responsive to KeyboardInterrupt
+            while not finished.wait(1):
+                pass
+
+        if self.vm_output is not None:
+            self._event("boot", start, self.vm_output)
 
-        self._check_call(["virsh", "start", self.domain])
-        self._forward_log()
         self._log_to_file("Connection to VM lost, waiting for VM to shutdown")
-        self._wait()
-        self._call(["virsh", "destroy", self.domain])
+        with self._phase("shutdown"):
+            self._wait()
+            hypervisor().destroy(self.domain)
+            while receiver.is_alive():
+                receiver.join(1)
+
+        if self.server is not None and self.server.packages is not None:
+            stats = self.server.packages.stats
+            self._log_to_file("Package cache: %d hits (%d bytes), %d misses (%d bytes), %d uncached" %
+                              (stats['hits'], stats['hit_bytes'], stats['misses'],
+                               stats['miss_bytes'], stats['uncached']))
+            self._event("package-cache", start, time.time(), **stats)
+
+        # Partially received artifacts must not end up in a successful build
+        if receiver.error is not None:
+            raise receiver.error[0], receiver.error[1], receiver.error[2]
 
     def build(self):
         if not self.fs_is_file("/build/source/boot.sh"):
             raise RuntimeError("Unable to find /build/source/boot.sh in VM")
 
         assert not self.fs_exists("/build/wrapper.sh")
+        assert not self.fs_exists("/build/export.sh")
         assert not self.fs_exists("/build/status")
         assert not self.fs_exists("/build/log")
 
@@ -565,6 +1796,7 @@ class BuildJob(object):
 
         elif self.fs_exists("/etc/rc.local"):
             self._log_to_file("Using rc.local based startup sequence")
+            self.fs_cp("/etc/rc.local", "/etc/rc.local.builder")
             self.fs_upload_file("/etc/rc.local", os.path.join(BUILDER_ROOT, "rc.local"))
             self.fs_chmod("/etc/rc.local", 0755)
 
@@ -581,10 +1813,6 @@ class BuildJob(object):
         with open(os.path.join(BUILDER_ROOT, "wrapper.sh"), 'rb') as fp:
             wrapper = fp.read()
 
-        wrapper = re.sub("^LOG_TTY=\".*\"$",
-                         "LOG_TTY=\"%s\"" % self.settings["log_tty"],
-                         wrapper, flags=re.MULTILINE)
-
         wrapper = re.sub("^BUILD_USER=\".*\"$",
                          "BUILD_USER=\"%s\"" % self.settings["build_user"],
                          wrapper, flags=re.MULTILINE)
@@ -593,70 +1821,442 @@ class BuildJob(object):
                          "BUILD_GROUP=\"%s\"" % self.settings["build_group"],
                          wrapper, flags=re.MULTILINE)
 
+        # Readiness handshake and package proxy, both provided by the host
+        if self.network is not None and self.server is None:
+            packages = None
+            if self.settings["package_cache"]:
+                family = re.match("^[a-z]+", self.machine).group(0)
+                packages = PackageCache(os.path.join(BUILDER_PACKAGES, family))
+            self.server = JobServer(self, self.network, packages)
+
+        ready_url, proxy_url = "", ""
+        if self.server is not None:
+            if self.settings["ready_timeout"] > 0:
+                ready_url = self.server.url("/ready")
+            if self.server.packages is not None:
+                proxy_url = self.server.url("/")
+
+        wrapper = re.sub("^PROXY_URL=\".*\"$",
+                         "PROXY_URL=\"%s\"" % proxy_url,
+                         wrapper, flags=re.MULTILINE)
+
+        wrapper = re.sub("^READY_URL=\".*\"$",
+                         "READY_URL=\"%s\"" % ready_url,
+                         wrapper, flags=re.MULTILINE)
+
+        # Leave some room for filesystem overhead
+        ccache_size = ""
+        if self.ccache is not None:
+            ccache_size = "%dM" % (self.settings["ccache"] * 1024 * 9 // 10)
+
+        wrapper = re.sub("^CCACHE_SIZE=\".*\"$",
+                         "CCACHE_SIZE=\"%s\"" % ccache_size,
+                         wrapper, flags=re.MULTILINE)
+
+        wrapper = re.sub("^BUILD_TREE_STATE=\".*\"$",
+                         "BUILD_TREE_STATE=\"%s\"" % (self.build_tree or ""),
+                         wrapper, flags=re.MULTILINE)
+
+        wrapper = re.sub("^READY_TIMEOUT=\".*\"$",
+                         "READY_TIMEOUT=\"%d\"" % self.settings["ready_timeout"],
+                         wrapper, flags=re.MULTILINE)
+
         self.fs_upload_content("/build/wrapper.sh", wrapper)
         self.fs_chmod("/build/wrapper.sh", 0755)
+        self.fs_upload_file("/build/export.sh", os.path.join(BUILDER_ROOT, "export.sh"))
+        self.fs_chmod("/build/export.sh", 0755)
         self.fs_chmod("/build/source/boot.sh", 0755)
 
         # Run the actual build
         self.run()
 
-        # Check the status of the build
-        if not self.fs_is_file("/build/status"):
-            raise RuntimeError("Unable to determine status, build was aborted?")
+        # Status was already reported through the channel
+        status = self.vm_status
+        if status is None:
+            # Check the status of the build
+            if not self.fs_is_file("/build/status"):
+                raise RuntimeError("Unable to determine status, build was aborted?")
+            status = int(self.fs_download_content("/build/status"))
+
+        # Only a successful build leaves a consistent tree for the next one
+        if self.build_tree is not None and status == 0:
+            with open(self.build_tree_stamp, "wb") as fp:
+                fp.write("%s\n" % self.build_tree_key)
 
-        return int(self.fs_download_content("/build/status"))
+        return status
+
+    def cleanup(self):
+        """ Remove all traces of the build job from the VM. """
+        for f in self.fs_ls("/build"):
+            self.guestfs.rm_rf("/build/%s" % f)
+
+        self.guestfs.rm_f("/etc/systemd/system/multi-user.target.wants/buildjob.service")
+        self.guestfs.rm_f("/usr/lib/systemd/user/buildjob.service")
+        self.guestfs.rm_f("/etc/apt/apt.conf.d/99build-proxy")
+        if self.fs_exists("/etc/rc.local.builder"):
+            self.fs_mv("/etc/rc.local.builder", "/etc/rc.local")
 
     def prepare(self, local_path, local_deps=None):
         assert os.path.isdir(local_path)
         assert os.path.isfile(os.path.join(local_path, "boot.sh"))
-        self.fs_upload_recursive("/build/source", local_path)
+        with self._phase("upload") as info:
+            self.fs_upload_tree("/build/source", local_path)
+            info['files'], info['bytes'] = tree_size(local_path)
         assert self.fs_is_file("/build/source/boot.sh")
 
         if local_deps is not None:
             assert os.path.isdir(local_deps)
-            self.fs_upload_recursive("/build/source/deps", local_deps)
+            with self._phase("upload-deps") as info:
+                self.fs_upload_tree("/build/source/deps", local_deps)
+                info['files'], info['bytes'] = tree_size(local_deps)
 
-    def publish(self, local_path):
+    def _verify_artifact(self, name):
+        """ Check that a received artifact matches the file in the VM. """
+        if name not in self.artifacts:
+            return False
+        local_file, size, digests = self.artifacts[name]
+        path = "/build/%s" % name
+        if self.guestfs.filesize(path) == size and \
+           self.guestfs.checksum("sha256", path) == digests[0]:
+            return True
+        self._log_to_file("Artifact %s was modified after export, downloading again" % name)
+        return False
+
+    def publish(self, local_path, store=None):
         assert os.path.isdir(local_path)
         assert not os.path.exists(os.path.join(local_path, "internal_build.log"))
         assert not os.path.exists(os.path.join(local_path, "SHA256SUMS"))
         assert not os.path.exists(os.path.join(local_path, "MD5SUMS"))
 
-        shutil.copyfile(os.path.join(self.root, "build.log"),
-                        os.path.join(local_path, "internal_build.log"))
+        assert not os.path.exists(os.path.join(local_path, "build.log"))
+
+        # Decide before anything is written, a failure later would leave a half published result
+        if store is not None and not store.usable(local_path):
+            self._log_to_file("Blob store %s is on a different file system, not deduplicating" % store.root)
+            store = None
 
-        self.fs_download_file("/build/log", os.path.join(local_path, "build.log"))
+        with open(os.path.join(self.root, "build.log"), "rb") as src:
+            with open(os.path.join(local_path, "internal_build.log"), "wb") as dst:
+                digests = { "internal_build.log": hash_file(src, dst) }
 
         filelist = ["internal_build.log", "build.log"]
+        excludes = []
+        exported = []
 
         for f in self.fs_ls("/build"):
-            if f in ["wrapper.sh", "source", "log"]:
+            if f in ["wrapper.sh", "export.sh", "source"]:
+                excludes.append("./%s" % f)
                 continue
 
-            elif self.fs_is_file("/build/%s" % f):
-                self.fs_download_file("/build/%s" % f, os.path.join(local_path, f))
+            if not self.fs_is_file("/build/%s" % f):
+                self._log_to_file("Skipping download of directory %s" % f)
+                excludes.append("./%s" % f)
+                continue
+
+            if f != "log":
+                assert not os.path.exists(os.path.join(local_path, f))
                 filelist.append(f)
 
-            else:
-                self._log_to_file("Skipping download of directory %s" % f)
+            # Artifacts streamed while the VM was running only need to be verified
+            if self._verify_artifact(f):
+                excludes.append("./%s" % f)
+                exported.append(f)
+
+        with self._phase("verify") as info:
+            for f in exported:
+                local_file, size, digests[f] = self.artifacts[f]
+                shutil.move(local_file, os.path.join(local_path, f))
+            info['files'] = len(exported)
+            info['bytes'] = sum(self.artifacts[f][1] for f in exported)
+
+        # Fetch the remaining files at once, checksums are computed on the fly
+        downloads = [f for f in ["log"] + filelist[2:] if f not in exported]
+        self._log_to_file("Downloading %d files from VM, %d already received" %
+                          (len(downloads), len(exported)))
+        if len(downloads) > 0:
+            with self._phase("download") as info:
+                digests.update(self.fs_download_tree("/build", local_path, excludes=excludes))
+                info['files'] = len(downloads)
+                info['bytes'] = sum(os.path.getsize(os.path.join(local_path, f)) for f in downloads)
+
+        os.rename(os.path.join(local_path, "log"), os.path.join(local_path, "build.log"))
+        digests["build.log"] = digests.pop("log")
 
         with open(os.path.join(local_path, "SHA256SUMS"), "wb") as fp:
-            subprocess.check_call(["sha256sum", "--"] + filelist, cwd=local_path,
-                                  stdout=fp, stderr=subprocess.STDOUT)
+            for f in filelist:
+                fp.write(checksum_line(digests[f][0], f))
 
         with open(os.path.join(local_path, "MD5SUMS"), "wb") as fp:
-            subprocess.check_call(["md5sum", "--"] + filelist, cwd=local_path,
-                                  stdout=fp, stderr=subprocess.STDOUT)
+            for f in filelist:
+                fp.write(checksum_line(digests[f][1], f))
+
+        # Deduplicate artifacts, identical files share a blob
+        if store is not None:
+            for f in filelist[2:]:
+                store.add(os.path.join(local_path, f), digests[f][0])
+
+        # Not part of the checksums, the file is still written while publishing
+        shutil.copyfile(os.path.join(self.root, "events.jsonl"),
+                        os.path.join(local_path, "internal_events.jsonl"))
+
+
+def expire_layers(machine, keep):
+    """ Remove dependency layers of a machine which are not in use and were not used for a while. """
+    pattern = re.compile("^%s-([0-9a-f]{64})(-disk[0-9]+\\.qcow2|\\.lock)$" % re.escape(machine))
+    keys = set()
+    for f in os.listdir(BUILDER_LAYERS):
+        m = pattern.match(f)
+        if m is not None and m.group(1) != keep:
+            keys.add(m.group(1))
+
+    for key in keys:
+        prefix = "%s-%s" % (machine, key)
+        files = [f for f in os.listdir(BUILDER_LAYERS) if f.startswith(prefix)]
+        mtime = last_use([os.path.join(BUILDER_LAYERS, f) for f in files])
+        if mtime is None or time.time() - mtime < BUILDER_LAYER_EXPIRE * 86400:
+            continue
+
+        # Jobs hold a shared lock as long as their overlays use the layer
+        with open(os.path.join(BUILDER_LAYERS, "%s.lock" % prefix), "ab") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as exc:
+                if exc.errno not in [errno.EACCES, errno.EAGAIN]:
+                    raise
+                continue
+            for f in files:
+                if f.endswith(".qcow2") and os.path.exists(os.path.join(BUILDER_LAYERS, f)):
+                    os.unlink(os.path.join(BUILDER_LAYERS, f))
+            os.unlink(os.path.join(BUILDER_LAYERS, "%s.lock" % prefix))
+
+def dependency_layer(machine, manifest):
+    """ Get disk images with the dependencies from manifest installed, create them if necessary.
+        Also returns a shared lock which protects the layers from expiry until it is closed. """
+
+    identities = disk_identity(machine)
+    with open(manifest, "rb") as fp:
+        digest = hashlib.sha256(hash_file(fp)[0])
+    for identity in identities:
+        digest.update("disk\0%s\0%d\0%d\0" % identity)
+    key = digest.hexdigest()
+
+    layers = [os.path.join(BUILDER_LAYERS, "%s-%s-disk%d.qcow2" % (machine, key, i))
+              for i in xrange(len(identities))]
+
+    try_mkdir_p(BUILDER_LAYERS)
+    with open(os.path.join(BUILDER_LAYERS, "%s.lock" % machine), "ab") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+        # Opened while holding the machine lock, so it cannot be expired in between
+        usage_path = os.path.join(BUILDER_LAYERS, "%s-%s.lock" % (machine, key))
+        usage = open(usage_path, "ab")
+        set_cloexec(usage.fileno())
+        fcntl.flock(usage.fileno(), fcntl.LOCK_SH)
+        os.utime(usage_path, None) # Last use, for expiry
+
+        try:
+            expire_layers(machine, key)
+        except:
+            usage.close()
+            raise
 
+        if all(os.path.isfile(layer) for layer in layers):
+            return layers, usage
 
-if __name__ == "__main__":
+        job = None
+        try:
+            job = BuildJob(machine, persistent=True)
+            job._log_to_file("Creating dependency layer %s" % key)
+
+            source = os.path.join(job.root, "layer")
+            os.mkdir(source)
+            shutil.copy(manifest, os.path.join(source, "boot.sh"))
+            job.prepare(source)
+
+            status = job.build()
+            if status != 0:
+                raise RuntimeError("Installing dependencies exited with status code %d" % status)
+
+            job.cleanup()
+            job._stop_guestfs()
+
+            # Every later build uses the layers, they must be complete on disk before
+            # they get their final name
+            for disk, layer in zip(job.disks, layers):
+                os.chmod(disk, 0640) # only used as backing file from now on
+                shutil.move(disk, "%s.tmp" % layer)
+                with open("%s.tmp" % layer, "rb") as fp:
+                    os.fsync(fp.fileno())
+            for layer in layers:
+                os.rename("%s.tmp" % layer, layer)
+            fsync_dir(BUILDER_LAYERS)
+
+        except:
+            usage.close()
+            raise
+
+        finally:
+            if job is not None:
+                job._destroy()
+
+    return layers, usage
+
+def build_project(source):
+    """ Identify the project in source for its persistent build tree. """
+    source = os.path.realpath(source)
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", os.path.basename(source))
+    return "%s-%s" % (name, hashlib.sha256(source).hexdigest()[:12])
+
+def run_build(machine, source, destination, dependencies=None, debug=False, cache=None,
+              incremental=False):
+    """ Run a single build job and publish the result to destination. """
+
+    digest = None
+    if cache is not None:
+        digest = build_digest(machine, source, dependencies)
+        if cache.restore(digest, destination):
+            print "Using cached result %s for %s" % (digest, machine)
+            return 0
+
+    backing, layer_lock = None, None
+    if os.path.isfile(os.path.join(source, BUILDER_LAYER_MANIFEST)):
+        backing, layer_lock = dependency_layer(machine, os.path.join(source, BUILDER_LAYER_MANIFEST))
+
+    status = 1
+    job = None
+    try:
+        job = BuildJob(machine, backing, ccache=True,
+                       project=build_project(source) if incremental else None)
+        job.prepare(source, dependencies)
+
+        status = job.build()
+        if status != 0 and not debug:
+            raise RuntimeError("Build exited with status code %d" % status)
+
+        job.publish(destination, BlobStore())
+    finally:
+        if job is not None:
+            job._destroy()
+        if layer_lock is not None:
+            layer_lock.close()
+
+    if digest is not None and status == 0:
+        cache.save(digest, destination)
+
+    return status
+
+class BuildScheduler(object):
+    def __init__(self, max_jobs=None, max_vcpus=None, max_memory=None, max_disk=None):
+        """ Create a new scheduler, limits default to the resources of the host.
+            Disk space is accounted separately for each scratch directory. """
+
+        if max_vcpus is None:
+            max_vcpus = os.sysconf("SC_NPROCESSORS_ONLN")
+        if max_memory is None:
+            max_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024
+
+        self.max_disk   = max_disk
+        self.limits     = { 'jobs': max_jobs, 'vcpus': max_vcpus, 'memory': max_memory }
+        self.used       = { 'jobs': 0, 'vcpus': 0, 'memory': 0 }
+        self.pending    = []        # Jobs waiting for resources
+        self.failed     = []        # Jobs which did not succeed
+        self.cond       = threading.Condition()
+
+    def add(self, machine, source, destination, dependencies=None):
+        """ Queue a build, skipped if the destination is already populated. """
+
+        if not BUILDER_SETTINGS.has_key(machine):
+            raise RuntimeError("%s is not a supported VM" % machine)
+
+        # Same semantics as 'rmdir --ignore-fail-on-non-empty' followed by 'mkdir'
+        try_mkdir_p(os.path.dirname(os.path.abspath(destination)))
+        if os.path.isdir(destination) and len(os.listdir(destination)):
+            print "Skipping %s, %s is already populated" % (machine, destination)
+            return False
+        try_mkdir_p(destination)
+
+        settings = machine_settings(machine)
+        tree = domain_xml(machine)
+        apply_profile(tree, machine_profile(settings))
+        needs = domain_resources(tree, settings)
+        needs['jobs'] = 1
+
+        # Jobs sharing a scratch directory share its free space
+        scratch = scratch_root(settings)
+        key = "disk:%s" % scratch
+        if key not in self.limits:
+            try_mkdir_p(scratch)
+            self.limits[key] = self.max_disk if self.max_disk is not None else scratch_free(scratch)
+            self.used[key] = 0
+        needs[key] = needs.pop('disk')
+
+        # Jobs exceeding a limit are clamped, they will run as soon as the host is idle
+        for k in needs.iterkeys():
+            if self.limits[k] is not None:
+                needs[k] = min(needs[k], self.limits[k])
+
+        self.pending.append((machine, source, destination, dependencies, needs))
+        return True
+
+    def _fits(self, needs):
+        for k, need in needs.iteritems():
+            if self.limits[k] is not None and self.used[k] + need > self.limits[k]:
+                return False
+        return True
+
+    def _worker(self, entry, debug, cache, incremental):
+        machine, source, destination, dependencies, needs = entry
+        try:
+            status = run_build(machine, source, destination, dependencies, debug, cache, incremental)
+        except:
+            traceback.print_exc()
+            status = 1
+        with self.cond:
+            if status != 0:
+                self.failed.append(entry)
+            for k, need in needs.iteritems():
+                self.used[k] -= need
+            self.cond.notify_all()
+
+    def run(self, debug=False, cache=None, incremental=False):
+        """ Run all queued jobs, returns the number of failed jobs. """
+
+        threads = []
+        with self.cond:
+            while len(self.pending) or self.used['jobs']:
+                for entry in list(self.pending):
+                    needs = entry[4]
+                    if not self._fits(needs):
+                        continue
+                    for k, need in needs.iteritems():
+                        self.used[k] += need
+                    self.pending.remove(entry)
+                    print "Starting build for %s (%d running, %d pending)" % \
+                          (entry[0], self.used['jobs'], len(self.pending))
+                    thread = threading.Thread(target=self._worker, args=(entry, debug, cache, incremental))
+                    thread.start()
+                    threads.append(thread)
+
+                # Use a timeout to stay responsive to KeyboardInterrupt
+                self.cond.wait(1)
+
+        for thread in threads:
+            thread.join()
+
+        for entry in self.failed:
+            print "Build for %s (%s) failed" % (entry[0], entry[2])
+        return len(self.failed)
+
+def main_build(argv):
     parser = argparse.ArgumentParser(description="Minimalistic build server")
     parser.add_argument('--machine', help="Select build VM", required=True)
     parser.add_argument('--dependencies', help="Additional build dependencies", default=None)
     parser.add_argument('--debug', action='store_true', help="Enable debug mode")
+    parser.add_argument('--no-cache', action='store_true', help="Always build, even if a cached result exists")
+    parser.add_argument('--incremental', action='store_true', help="Reuse the build tree of the previous build")
     parser.add_argument('source', help="Source directory to process")
     parser.add_argument('destination', help="Destination directory")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if not BUILDER_SETTINGS.has_key(args.machine):
         raise RuntimeError("%s is not a supported VM" % args.machine)
@@ -670,19 +2270,99 @@ if __name__ == "__main__":
     if len(os.listdir(args.destination)):
         raise RuntimeError("%s is not empty, refusing to build" % args.destination)
 
-    status = 1
-    job = None
-    try:
-        job = BuildJob(args.machine)
-        job.prepare(args.source, args.dependencies)
-
-        status = job.build()
-        if status != 0 and not args.debug:
-            raise RuntimeError("Build exited with status code %d" % status)
+    return run_build(args.machine, args.source, args.destination, args.dependencies,
+                     args.debug, None if args.no_cache else BuildCache(), args.incremental)
 
-        job.publish(args.destination)
-    finally:
-        if job is not None:
-            job._destroy()
+def main_matrix(argv):
+    parser = argparse.ArgumentParser(prog="%s matrix" % sys.argv[0],
+                                     description="Run a matrix of builds concurrently")
+    parser.add_argument('--max-jobs', type=int, help="Maximum number of concurrent jobs", default=None)
+    parser.add_argument('--max-vcpus', type=int, help="Maximum number of vCPUs in use", default=None)
+    parser.add_argument('--max-memory', type=int, help="Maximum memory in use (MiB)", default=None)
+    parser.add_argument('--max-disk', type=int, help="Maximum disk space in use per scratch directory (GiB)", default=None)
+    parser.add_argument('--debug', action='store_true', help="Enable debug mode")
+    parser.add_argument('--no-cache', action='store_true', help="Always build, even if a cached result exists")
+    parser.add_argument('--incremental', action='store_true', help="Reuse the build trees of previous builds")
+    parser.add_argument('matrix', help="File with one 'machine source destination [dependencies]' per line")
+    args = parser.parse_args(argv)
+
+    scheduler = BuildScheduler(max_jobs=args.max_jobs, max_vcpus=args.max_vcpus,
+                               max_memory=args.max_memory * 1024 if args.max_memory else None,
+                               max_disk=args.max_disk * 1024**3 if args.max_disk else None)
+
+    with open(args.matrix, "r") as fp:
+        for line in fp:
+            line = line.split("#", 1)[0].split()
+            if not len(line):
+                continue
+            if len(line) not in [3, 4]:
+                raise RuntimeError("Invalid matrix entry: %s" % " ".join(line))
+            if not os.path.isdir(line[1]):
+                raise RuntimeError("%s is not a directory" % line[1])
+            scheduler.add(*line)
+
+    return 1 if scheduler.run(args.debug, None if args.no_cache else BuildCache(),
+                              args.incremental) else 0
+
+def main_stats(argv):
+    parser = argparse.ArgumentParser(prog="%s stats" % sys.argv[0],
+                                     description="Summarize build phase timings")
+    parser.add_argument('--machine', help="Only show a specific VM", default=None)
+    parser.add_argument('--phase', help="Only show a specific phase", default=None)
+    parser.add_argument('root', nargs='?', help="Directory with build results", default="repository/raw")
+    args = parser.parse_args(argv)
+
+    durations = {}
+    for dirpath, dirnames, filenames in os.walk(args.root):
+        if "internal_events.jsonl" not in filenames:
+            continue
+        with open(os.path.join(dirpath, "internal_events.jsonl"), "r") as fp:
+            for line in fp:
+                event = json.loads(line)
+                if args.machine is not None and event['machine'] != args.machine:
+                    continue
+                if args.phase is not None and event['phase'] != args.phase:
+                    continue
+                key = (event['machine'], event['phase'])
+                durations.setdefault(key, []).append((event['start'], event['duration']))
+
+    # The last build is flagged if it took 50% longer than the average of the previous ones
+    print "%-24s %-18s %5s %10s %10s %10s" % ("machine", "phase", "runs", "mean", "max", "last")
+    for (machine, phase), values in sorted(durations.iteritems()):
+        values  = [duration for start, duration in sorted(values)]
+        mean    = sum(values) / len(values)
+        flag    = ""
+        if len(values) > 1 and values[-1] > 1.5 * sum(values[:-1]) / (len(values) - 1):
+            flag = " !"
+        print "%-24s %-18s %5d %10.1f %10.1f %10.1f%s" % \
+              (machine, phase, len(values), mean, max(values), values[-1], flag)
+
+    return 0
+
+def main_gc(argv):
+    parser = argparse.ArgumentParser(prog="%s gc" % sys.argv[0],
+                                     description="Delete unreferenced artifacts from the blob store")
+    parser.add_argument('--dry-run', action='store_true', help="Only show what would be deleted")
+    parser.add_argument('--max-age', type=int, help="Also expire cached builds older than this (days)", default=None)
+    parser.add_argument('store', nargs='?', help="Blob store directory", default=BUILDER_STORE)
+    args = parser.parse_args(argv)
+
+    # Cached builds keep their blobs alive, expire them first
+    if args.max_age is not None:
+        expired = BuildCache().expire(args.max_age * 86400, args.dry_run)
+        print "%s %d cached builds" % ("Found" if args.dry_run else "Expired", expired)
+
+    removed, size = BlobStore(args.store).gc(args.dry_run)
+    print "%s %d unreferenced blobs (%d bytes)" % ("Found" if args.dry_run else "Deleted", removed, size)
+    return 0
+
+BUILDER_COMMANDS = {
+    "matrix": main_matrix,
+    "stats":  main_stats,
+    "gc":     main_gc,
+}
 
-    exit(status)
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and BUILDER_COMMANDS.has_key(sys.argv[1]):
+        exit(BUILDER_COMMANDS[sys.argv[1]](sys.argv[2:]))
+    exit(main_build(sys.argv[1:]))
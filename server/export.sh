@@ -0,0 +1,69 @@
+#!/bin/bash
+#
+# Stream finished build artifacts to the build server while the VM is running.
+#
+# Copyright (C) 2014-2015 Sebastian Lackner
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+# Usage: /build/export.sh /build/<file> [...]
+#
+# boot.sh can call this as soon as an artifact in /build is complete, the
+# file must not be modified afterwards. Each file is sent as a header line
+# "F <size> <octal mode> <name>" followed by exactly <size> bytes. Files
+# are exported at most once, remaining files are sent by wrapper.sh after
+# boot.sh has finished. The build server verifies all received files
+# against the disk image after shutdown.
+
+EXPORT_PORT="/dev/virtio-ports/org.winehq.build.1"
+EXPORT_STATE="/run/build-export"
+
+if [ ! -e "$EXPORT_PORT" ]; then
+    exit 0
+fi
+
+mkdir -p "$EXPORT_STATE"
+status=0
+
+for file in "$@"; do
+    name="$(basename "$file")"
+    if [ "$(dirname "$file")" != "/build" ] || [ ! -f "$file" ]; then
+        echo "ERROR: $file is not a file in /build, not exported." >&2
+        status=1
+        continue
+    fi
+    case "$name" in
+        wrapper.sh|export.sh)
+            continue
+            ;;
+    esac
+
+    # Only one writer at a time, the frames must not interleave
+    (
+        flock 9
+        if [ -e "$EXPORT_STATE/$name" ]; then
+            exit 0
+        fi
+        size="$(stat -c %s "$file")"
+        mode="$(stat -c %a "$file")"
+        {
+            echo "F $size $mode $name"
+            # Pad or truncate, a modified file must not break the framing
+            cat "$file" /dev/zero 2>/dev/null | head -c "$size"
+        } > "$EXPORT_PORT" && touch "$EXPORT_STATE/$name"
+    ) 9> "$EXPORT_STATE.lock" || status=1
+done
+
+exit "$status"
@@ -21,19 +21,26 @@
 #
 
 import argparse
+import contextlib
 import errno
+import fcntl
 import hashlib
+import json
 import os
 import re
 import shutil
 import stat
 import subprocess
+import sys
 import tempfile
+import threading
 import time
 
 BUILDER_SIGNKEY = "5FCBF54A"
 BUILDER_TOOLS   = os.path.join(os.path.dirname(os.path.realpath(__file__)), "./tools")
 BUILDER_CERTS   = os.path.join(os.path.dirname(os.path.realpath(__file__)), "./certs")
+BUILDER_SIGN_JOBS = 4 # Maximum number of packages signed concurrently
+BUILDER_METADATA_CACHE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "./metadata-cache")
 assert os.path.isdir(os.path.join(BUILDER_TOOLS, "bin"))
 assert os.path.isdir(os.path.join(BUILDER_TOOLS, "lib/x86_64-linux-gnu/perl5/5.20"))
 assert os.path.isdir(os.path.join(BUILDER_TOOLS, "share/perl5"))
@@ -50,6 +57,22 @@ def try_mkdir_p(path):
             raise
     return True
 
+def set_cloexec(fd):
+    """ Do not leak fd into subprocesses, a daemonizing child would keep a lock held. """
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fd
+
+def copy_file(src, dst):
+    """ Copy a file, shares the data blocks on file systems with reflink support. """
+    subprocess.check_call(["cp", "--reflink=auto", "--", src, dst])
+
+@contextlib.contextmanager
+def timed(step):
+    """ Print the time spent in a step. """
+    start = time.time()
+    yield
+    print "%s took %.3fs" % (step, time.time() - start)
+
 def check_output_with_input(*popenargs, **kwargs):
     if 'stdout' in kwargs or 'stdin' in kwargs:
         raise ValueError('stdout/stdin argument not allowed')
@@ -71,15 +94,119 @@ def check_output_with_input(*popenargs, **kwargs):
 
     return output
 
+def boot_id():
+    """ Identify the current boot of the host. """
+    with open("/proc/sys/kernel/random/boot_id", "r") as fp:
+        return fp.read().strip()
+
+def process_alive(pid, boot):
+    """ Check if a process recorded on some boot is still running. """
+    if boot != boot_id():
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
 class DirectoryLock(object):
     def __init__(self, path):
-        self.path = os.path.abspath(path)
-        self.lock = "/tmp/builder-%s.lock" % hashlib.md5(self.path).hexdigest()
+        """ Exclusive lock on a repository, waiters are served in FIFO order. """
+        self.path   = os.path.abspath(path)
+        self.lock   = "/tmp/builder-%s.lock" % hashlib.md5(self.path).hexdigest()
+        self.ticket = None      # Our ticket, flocked as long as we wait or own the lock
+        self.name   = None      # File name of our ticket
+        self.start  = None      # Time when we started waiting
+        self.owned  = None      # Time when we got the lock
+
+    @contextlib.contextmanager
+    def _queue(self):
+        """ Serialize modifications of the ticket queue. """
+        with open(os.path.join(self.lock, "queue"), "a") as fp:
+            set_cloexec(fp.fileno())
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _tickets(self):
+        return sorted(f for f in os.listdir(self.lock) if re.match("^[0-9]{12}\\.ticket$", f))
+
+    def _set_state(self, state):
+        self.ticket.seek(0)
+        self.ticket.truncate()
+        self.ticket.write(json.dumps({ 'state': state, 'pid': os.getpid(), 'boot_id': boot_id() }))
+        self.ticket.flush()
+
+    def _wait_ticket(self, fp, name):
+        """ Block until the owner of a ticket is gone, cleans up if it did not finish properly. """
+        fcntl.flock(fp.fileno(), fcntl.LOCK_SH)
+        with self._queue():
+            path = os.path.join(self.lock, name)
+            try:
+                if os.stat(path).st_ino != os.fstat(fp.fileno()).st_ino:
+                    return
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    return
+                raise
+
+            try:
+                info = json.loads(fp.read())
+            except ValueError:
+                info = { 'state': "unknown", 'pid': 0, 'boot_id': None }
+            if process_alive(info['pid'], info['boot_id']):
+                reason = "process %d lost the lock" % info['pid']
+            else:
+                reason = "process %d is no longer running" % info['pid']
+            print "Removing stale %s ticket %s of %s, %s" % (info['state'], name, self.path, reason)
+            os.unlink(path)
+
     def __enter__(self):
-        while not try_mkdir_p(self.lock):
-            time.sleep(0.5)
+        self.start = time.time()
+        try_mkdir_p(self.lock)
+
+        # Take a ticket, it is locked before anyone else can see it
+        with self._queue():
+            tickets = self._tickets()
+            self.name = "%012d.ticket" % (int(tickets[-1][:12]) + 1 if len(tickets) else 0)
+            self.ticket = open(os.path.join(self.lock, self.name), "w")
+            set_cloexec(self.ticket.fileno())
+            fcntl.flock(self.ticket.fileno(), fcntl.LOCK_EX)
+            self._set_state("waiting")
+
+        # Wait until all tickets in front of us are gone
+        try:
+            while True:
+                with self._queue():
+                    ahead = [f for f in self._tickets() if f < self.name]
+                    if not len(ahead):
+                        break
+                    fp = open(os.path.join(self.lock, ahead[-1]), "r")
+                    set_cloexec(fp.fileno())
+                with fp:
+                    self._wait_ticket(fp, ahead[-1])
+        except:
+            self._release()
+            raise
+
+        self.owned = time.time()
+        self._set_state("owner")
+        print "Acquired lock on %s after %.3fs" % (self.path, self.owned - self.start)
+
+    def _release(self):
+        with self._queue():
+            self._set_state("released")
+            os.unlink(os.path.join(self.lock, self.name))
+        self.ticket.close()
+        self.ticket = None
+
     def __exit__(self, type, value, traceback):
-        os.rmdir(self.lock)
+        self._release()
+        end = time.time()
+        print "Released lock on %s after %.3fs" % (self.path, end - self.owned)
+        with open(os.path.join(self.lock, "metrics.log"), "a") as fp:
+            fp.write("%s pid=%d wait=%.3f hold=%.3f\n" %
+                     (time.strftime("%Y-%m-%d %H:%M:%S"), os.getpid(),
+                      self.owned - self.start, end - self.owned))
         return False
 
 def key_fingerprint(filename):
@@ -96,7 +223,62 @@ def key_fingerprint(filename):
     assert m2 is not None
     return m1.group(1).replace(" ", ""), m2.group(1).strip()
 
-def publish(local_path, repository, signkey):
+def gpg_agent_available():
+    """ Check if a gpg-agent is reachable which can cache the passphrase. """
+    if os.environ.get("GPG_AGENT_INFO"):
+        return True
+    with open(os.devnull, "wb") as null:
+        try:
+            return subprocess.call(["gpg-connect-agent", "/bye"], stdout=null, stderr=null) == 0
+        except OSError:
+            return False
+
+def sign_packages(signkey, packages, sign, jobs=BUILDER_SIGN_JOBS):
+    """ Call sign for all packages using a pool of worker threads. The first failure
+        stops the remaining packages and is raised again when all workers are done. """
+
+    if gpg_agent_available():
+        # Ask for the passphrase once, the workers use the key cached by the gpg-agent
+        subprocess.check_call(["gpg", "--use-agent", "--yes", "-u", signkey, "--detach-sign",
+                               "--output", "/dev/null", "/dev/null"])
+    elif jobs > 1:
+        # Otherwise each worker would ask for the passphrase on the same terminal
+        print "No gpg-agent available, signing packages one at a time"
+        jobs = 1
+
+    pending = list(packages)
+    errors  = []
+    lock    = threading.Lock()
+
+    def _worker():
+        while True:
+            with lock:
+                if len(errors) or not len(pending):
+                    return
+                f = pending.pop(0)
+            start = time.time()
+            try:
+                sign(f)
+            except:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+            with lock:
+                print "Signed %s in %.3fs" % (f, time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=_worker) for i in xrange(min(jobs, len(pending)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors):
+        raise errors[0][0], errors[0][1], errors[0][2]
+    print "Signed %d packages in %.3fs" % (len(packages), time.time() - start)
+
+def read_build(local_path):
+    """ Check the status of a build and classify its packages. """
 
     # Determine status of build
     status_file = os.path.join(local_path, "status")
@@ -108,40 +290,75 @@ def publish(local_path, repository, signkey):
     if status != 0:
         raise RuntimeError("Build failed, not pushing to repository")
 
-    packages_deb        = []
-    packages_rpm        = []
-    packages_archlinux  = []
-    packages_macosx     = []
+    packages = { 'deb': [], 'rpm': [], 'archlinux': [], 'macosx': [] }
 
     for f in os.listdir(local_path):
         if os.path.isfile(os.path.join(local_path, f)):
             if f.endswith(".deb"):
-                packages_deb.append(f)
+                packages['deb'].append(f)
             elif f.endswith(".rpm"):
-                packages_rpm.append(f)
+                packages['rpm'].append(f)
             elif f.endswith(".pkg.tar.xz"):
-                packages_archlinux.append(f)
+                packages['archlinux'].append(f)
             elif f.endswith(".pkg"):
-                packages_macosx.append(f)
+                packages['macosx'].append(f)
             elif re.match("^portable-.*-osx(64)?\\.tar\\.gz$", f):
-                packages_macosx.append(f)
-
-    # needed for repo-add / genhdlist2
-    def _preexec_fn():
-        os.environ["PATH"] += ":%s" % os.path.join(BUILDER_TOOLS, "bin")
-        os.environ["PERL5LIB"] = "%s:%s" % (os.path.join(BUILDER_TOOLS, "lib/x86_64-linux-gnu/perl5/5.20"),
-                                            os.path.join(BUILDER_TOOLS, "share/perl5"))
-
-    # needed for rpm
-    def _preexec_fn_setsid():
-        _preexec_fn()
-        os.setsid()
+                packages['macosx'].append(f)
 
-    if repository.endswith("/"):
-        repository = repository[:-1]
+    return packages
 
-    # Update the repository
+def repository_type(repository):
+    """ Determine the kind of a repository from its path. """
+    repository = repository.rstrip("/")
     if re.match("^(.*/)?debian$", repository):
+        return "debian"
+    elif re.match("^(.*/)?arch/(x86_64|i686)$", repository):
+        return "arch"
+    elif re.match("^(.*/)?mageia/[0-9]+$", repository):
+        return "mageia"
+    elif re.match("^(.*/)?fedora/[0-9]+$", repository):
+        return "fedora"
+    elif re.match("^(.*/)?macosx/i686", repository):
+        return "macosx"
+    raise NotImplementedError("Publishing for repository %s not defined" % repository)
+
+def publish(local_path, destinations):
+    """ Publish a build to a list of (repository, signkey) destinations. The build is
+        only read once, each repository is locked only while it is updated. """
+
+    packages = read_build(local_path)
+
+    # Nothing is published unless all destinations are usable
+    checked = []
+    for repository, signkey in destinations:
+        repository = repository.rstrip("/")
+        with timed("Checking %s" % repository):
+            checked.append((repository, signkey, check_repository(packages, repository, signkey)))
+
+    for repository, signkey, info in checked:
+        with timed("Publishing to %s" % repository):
+            publish_repository(local_path, packages, repository, signkey, info)
+
+def check_repository(packages, repository, signkey):
+    """ Verify that a build can be published to a repository with the given key,
+        returns information about the repository needed for publishing. """
+
+    packages_deb        = packages['deb']
+    packages_rpm        = packages['rpm']
+    packages_archlinux  = packages['archlinux']
+    packages_macosx     = packages['macosx']
+
+    # The secret key is needed for signing packages and metadata
+    with open(os.devnull, "wb") as null:
+        if subprocess.call(["gpg", "--list-secret-keys", "--", signkey], stdout=null, stderr=null) != 0:
+            raise RuntimeError("Secret key %s for %s is not available" % (signkey, repository))
+
+    # The repository directory is only created when publishing, resolve the
+    # shared key without going through it
+    release_key = os.path.join(os.path.dirname(os.path.dirname(repository)), "Release.key")
+
+    info = { 'kind': repository_type(repository) }
+    if info['kind'] == "debian":
         assert len(packages_deb)        > 0
         assert len(packages_rpm)        == 0
         assert len(packages_archlinux)  == 0
@@ -172,174 +389,236 @@ def publish(local_path, repository, signkey):
 
         # Verify repository key
         assert key_fingerprint(os.path.join(repository, "../Release.key"))[0].endswith(signkey)
+        info['codename'] = codename
+
+    elif info['kind'] == "arch":
+        assert len(packages_deb)        == 0
+        assert len(packages_rpm)        == 0
+        assert len(packages_archlinux)  > 0
+        assert len(packages_macosx)     == 0
+
+        # Verify repository key
+        assert key_fingerprint(release_key)[0].endswith(signkey)
+
+    elif info['kind'] == "mageia":
+        assert len(packages_deb)        == 0
+        assert len(packages_rpm)        > 0
+        assert len(packages_archlinux)  == 0
+        assert len(packages_macosx)     == 0
+
+        # Make sure packages contain architecture
+        sub_repositories = set()
+        for f in packages_rpm:
+            m = re.match("^(.*)\\.(i586|x86_64)\\.rpm$", f)
+            assert m is not None
+            sub_repositories.add(m.group(2))
+
+        # Verify repository key
+        fingerprint, keyname = key_fingerprint(release_key)
+        assert fingerprint.endswith(signkey)
+        for d in sub_repositories:
+            assert key_fingerprint(os.path.join(repository, "%s/media_info/pubkey" % d))[0].endswith(signkey)
+        info['sub_repositories'] = sub_repositories
+        info['keyname'] = keyname
+
+    elif info['kind'] == "fedora":
+        assert len(packages_deb)        == 0
+        assert len(packages_rpm)        > 0
+        assert len(packages_archlinux)  == 0
+        assert len(packages_macosx)     == 0
+
+        # Make sure packages contain architecture
+        sub_repositories = set()
+        for f in packages_rpm:
+            m = re.match("^(.*)\\.(i686|x86_64)\\.rpm$", f)
+            assert m is not None
+            sub_repositories.add(m.group(2))
+
+        # Verify repository key
+        fingerprint, keyname = key_fingerprint(release_key)
+        assert fingerprint.endswith(signkey)
+        info['sub_repositories'] = sub_repositories
+        info['keyname'] = keyname
+
+    elif info['kind'] == "macosx":
+        assert len(packages_deb)        == 0
+        assert len(packages_rpm)        == 0
+        assert len(packages_archlinux)  == 0
+        assert len(packages_macosx)     > 0
+
+        # Verify repository key
+        assert key_fingerprint(release_key)[0].endswith(signkey)
+
+    return info
+
+def publish_repository(local_path, packages, repository, signkey, info):
+
+    packages_deb        = packages['deb']
+    packages_rpm        = packages['rpm']
+    packages_archlinux  = packages['archlinux']
+    packages_macosx     = packages['macosx']
+
+    # needed for repo-add / genhdlist2
+    def _preexec_fn():
+        os.environ["PATH"] += ":%s" % os.path.join(BUILDER_TOOLS, "bin")
+        os.environ["PERL5LIB"] = "%s:%s" % (os.path.join(BUILDER_TOOLS, "lib/x86_64-linux-gnu/perl5/5.20"),
+                                            os.path.join(BUILDER_TOOLS, "share/perl5"))
+
+    # needed for rpm
+    def _preexec_fn_setsid():
+        _preexec_fn()
+        os.setsid()
+
+    # Update the repository, check_repository() already verified it
+    kind = info['kind']
+    if kind == "debian":
+        codename = info['codename']
 
         temppath = tempfile.mkdtemp()
         try:
-            for f in packages_deb:
-                shutil.copy(os.path.join(local_path, f), temppath)
-                subprocess.check_call(["dpkg-sig", "--sign", "builder", "-k",
-                                       signkey, os.path.join(temppath, f)])
+            def _sign(f):
+                copy_file(os.path.join(local_path, f), temppath)
+                subprocess.check_call(["dpkg-sig", "--sign", "builder", "-k", signkey,
+                                       "-g", "--use-agent", os.path.join(temppath, f)])
+
+            sign_packages(signkey, packages_deb, _sign)
 
-            with DirectoryLock(repository):
-                for f in packages_deb:
-                    subprocess.check_call(["reprepro", "-b", repository, "includedeb",
-                                           codename, os.path.join(temppath, f)])
+            with timed("Repository update"), DirectoryLock(repository):
+                with timed("reprepro includedeb"):
+                    subprocess.check_call(["reprepro", "-b", repository, "includedeb", codename] +
+                                          [os.path.join(temppath, f) for f in packages_deb])
 
         finally:
             shutil.rmtree(temppath)
 
-    elif re.match("^(.*/)?arch/(x86_64|i686)$", repository):
-        assert len(packages_deb)        == 0
-        assert len(packages_rpm)        == 0
-        assert len(packages_archlinux)  > 0
-        assert len(packages_macosx)     == 0
-
+    elif kind == "arch":
         # Create repository path if it doesn't exist
         try_mkdir_p(repository)
 
-        # Verify repository key
-        assert key_fingerprint(os.path.join(repository, "../../Release.key"))[0].endswith(signkey)
-
         temppath = tempfile.mkdtemp()
         try:
-            for f in packages_archlinux:
-                shutil.copy(os.path.join(local_path, f), temppath)
-                subprocess.check_call(["gpg", "--detach-sign", "-u", signkey,
+            def _sign(f):
+                copy_file(os.path.join(local_path, f), temppath)
+                subprocess.check_call(["gpg", "--use-agent", "--detach-sign", "-u", signkey,
                                        "--no-armor", os.path.join(temppath, f)])
 
-            with DirectoryLock(repository):
+            sign_packages(signkey, packages_archlinux, _sign)
+
+            with timed("Repository update"), DirectoryLock(repository):
                 for f in packages_archlinux:
                     if os.path.isfile(os.path.join(repository, f)) or \
                        os.path.isfile(os.path.join(repository, "%s.sig" % f)):
                         raise RuntimeError("new package would overwrite existing one")
 
-                for f in packages_archlinux:
-                    shutil.copy(os.path.join(temppath, f), repository)
-                    shutil.copy(os.path.join(temppath, "%s.sig" % f), repository)
+                with timed("Copying packages"):
+                    for f in packages_archlinux:
+                        copy_file(os.path.join(temppath, f), repository)
+                        copy_file(os.path.join(temppath, "%s.sig" % f), repository)
 
-                for f in packages_archlinux:
+                # The database is rebuilt once for all packages
+                with timed("repo-add"):
                     subprocess.check_call(["repo-add", "-v", "-s", "-k", signkey,
-                                           "-d", "-f", os.path.join(repository, "winehq.db.tar.gz"),
-                                           os.path.join(repository, f)], preexec_fn=_preexec_fn)
+                                           "-d", "-f", os.path.join(repository, "winehq.db.tar.gz")] +
+                                          [os.path.join(repository, f) for f in packages_archlinux],
+                                          preexec_fn=_preexec_fn)
 
         finally:
             shutil.rmtree(temppath)
 
-    elif re.match("^(.*/)?mageia/[0-9]+$", repository):
-        assert len(packages_deb)        == 0
-        assert len(packages_rpm)        > 0
-        assert len(packages_archlinux)  == 0
-        assert len(packages_macosx)     == 0
-
-        # Make sure packages contain architecture
-        sub_repositories = set()
-        for f in packages_rpm:
-            m = re.match("^(.*)\\.(i586|x86_64)\\.rpm$", f)
-            assert m is not None
-            sub_repositories.add(m.group(2))
+    elif kind == "mageia":
+        sub_repositories, keyname = info['sub_repositories'], info['keyname']
 
         # Create repository path if it doesn't exist
         for d in sub_repositories:
             try_mkdir_p(os.path.join(repository, d))
 
-        # Verify repository key
-        fingerprint, keyname = key_fingerprint(os.path.join(repository, "../../Release.key"))
-        assert fingerprint.endswith(signkey)
-        for d in sub_repositories:
-            assert key_fingerprint(os.path.join(repository, "%s/media_info/pubkey" % d))[0].endswith(signkey)
-
         temppath = tempfile.mkdtemp()
         try:
-            for f in packages_rpm:
-                shutil.copy(os.path.join(local_path, f), temppath)
+            def _sign(f):
+                copy_file(os.path.join(local_path, f), temppath)
                 check_output_with_input(["rpm", "--define=%%_gpg_name %s" % keyname,
                                         "--addsign", os.path.join(temppath, f)],
                                         input="\n\n", preexec_fn=_preexec_fn_setsid)
 
-            with DirectoryLock(repository):
+            sign_packages(signkey, packages_rpm, _sign)
+
+            with timed("Repository update"), DirectoryLock(repository):
                 for f in packages_rpm:
                     d = re.match("^(.*)\\.(i586|x86_64)\\.rpm$", f).group(2)
                     if os.path.isfile(os.path.join(os.path.join(repository, d), f)):
                         raise RuntimeError("new package would overwrite existing one")
 
-                for f in packages_rpm:
-                    d = re.match("^(.*)\\.(i586|x86_64)\\.rpm$", f).group(2)
-                    shutil.copy(os.path.join(temppath, f), os.path.join(repository, d))
+                with timed("Copying packages"):
+                    for f in packages_rpm:
+                        d = re.match("^(.*)\\.(i586|x86_64)\\.rpm$", f).group(2)
+                        copy_file(os.path.join(temppath, f), os.path.join(repository, d))
 
+                # Without --clean, genhdlist2 reuses the existing hdlist and only
+                # reads packages which were added or removed since the last run
                 for d in sub_repositories:
-                    subprocess.check_call(["genhdlist2", "--xml-info", os.path.join(repository, d)],
-                                          preexec_fn=_preexec_fn)
+                    with timed("genhdlist2 %s" % d):
+                        subprocess.check_call(["genhdlist2", "--xml-info", os.path.join(repository, d)],
+                                              preexec_fn=_preexec_fn)
 
         finally:
             shutil.rmtree(temppath)
 
-    elif re.match("^(.*/)?fedora/[0-9]+$", repository):
-        assert len(packages_deb)        == 0
-        assert len(packages_rpm)        > 0
-        assert len(packages_archlinux)  == 0
-        assert len(packages_macosx)     == 0
-
-        # Make sure packages contain architecture
-        sub_repositories = set()
-        for f in packages_rpm:
-            m = re.match("^(.*)\\.(i686|x86_64)\\.rpm$", f)
-            assert m is not None
-            sub_repositories.add(m.group(2))
+    elif kind == "fedora":
+        sub_repositories, keyname = info['sub_repositories'], info['keyname']
 
         # Create repository path if it doesn't exist
         for d in sub_repositories:
             try_mkdir_p(os.path.join(repository, d))
 
-        # Verify repository key
-        fingerprint, keyname = key_fingerprint(os.path.join(repository, "../../Release.key"))
-        assert fingerprint.endswith(signkey)
-
         temppath = tempfile.mkdtemp()
         try:
-            for f in packages_rpm:
-                shutil.copy(os.path.join(local_path, f), temppath)
+            def _sign(f):
+                copy_file(os.path.join(local_path, f), temppath)
                 check_output_with_input(["rpm", "--define=%%_gpg_name %s" % keyname,
                                         "--addsign", os.path.join(temppath, f)],
                                         input="\n\n", preexec_fn=_preexec_fn_setsid)
 
-            with DirectoryLock(repository):
+            sign_packages(signkey, packages_rpm, _sign)
+
+            with timed("Repository update"), DirectoryLock(repository):
                 for f in packages_rpm:
                     d = re.match("^(.*)\\.(i686|x86_64)\\.rpm$", f).group(2)
                     if os.path.isfile(os.path.join(os.path.join(repository, d), f)):
                         raise RuntimeError("new package would overwrite existing one")
 
-                for f in packages_rpm:
-                    d = re.match("^(.*)\\.(i686|x86_64)\\.rpm$", f).group(2)
-                    shutil.copy(os.path.join(temppath, f), os.path.join(repository, d))
-
-                subprocess.check_call(["createrepo", repository], preexec_fn=_preexec_fn)
-                subprocess.check_call(["gpg", "--yes", "--detach-sign", "-u", signkey,
-                                       "--armor", os.path.join(repository, "repodata/repomd.xml")])
+                with timed("Copying packages"):
+                    for f in packages_rpm:
+                        d = re.match("^(.*)\\.(i686|x86_64)\\.rpm$", f).group(2)
+                        copy_file(os.path.join(temppath, f), os.path.join(repository, d))
+
+                # Reuse the previous metadata, only new or changed packages are read. The
+                # cache directory stores checksums of packages by header, outside of the
+                # published tree.
+                cachedir = os.path.join(BUILDER_METADATA_CACHE, hashlib.md5(os.path.abspath(repository)).hexdigest())
+                try_mkdir_p(cachedir)
+                with timed("createrepo"):
+                    subprocess.check_call(["createrepo", "--update", "--cachedir", cachedir, repository],
+                                          preexec_fn=_preexec_fn)
+                with timed("Signing repomd.xml"):
+                    subprocess.check_call(["gpg", "--use-agent", "--yes", "--detach-sign", "-u", signkey,
+                                           "--armor", os.path.join(repository, "repodata/repomd.xml")])
 
         finally:
             shutil.rmtree(temppath)
 
-    elif re.match("^(.*/)?macosx/i686", repository):
-        assert len(packages_deb)        == 0
-        assert len(packages_rpm)        == 0
-        assert len(packages_archlinux)  == 0
-        assert len(packages_macosx)     > 0
-
+    elif kind == "macosx":
         # Create repository path if it doesn't exist
         try_mkdir_p(repository)
 
-        # Verify repository key
-        assert key_fingerprint(os.path.join(repository, "../../Release.key"))[0].endswith(signkey)
-
         temppath = tempfile.mkdtemp()
         try:
             checksums = {}
-            for f in packages_macosx:
-                shutil.copy(os.path.join(local_path, f), temppath)
+            def _sign(f):
+                copy_file(os.path.join(local_path, f), temppath)
 
                 if f.endswith(".pkg"):
-                    digestinfo = os.path.join(temppath, "digestinfo.dat")
-                    signature  = os.path.join(temppath, "signature.dat")
+                    digestinfo = os.path.join(temppath, "%s.digestinfo.dat" % f)
+                    signature  = os.path.join(temppath, "%s.signature.dat" % f)
 
                     subprocess.check_call(["xar", "--sign", "-f", os.path.join(temppath, f),
                                            "--digestinfo-to-sign", digestinfo,
@@ -358,11 +637,13 @@ def publish(local_path, repository, signkey):
                     os.remove(digestinfo)
                     os.remove(signature)
 
-                subprocess.check_call(["gpg", "--detach-sign", "-u", signkey,
+                subprocess.check_call(["gpg", "--use-agent", "--detach-sign", "-u", signkey,
                                        "--no-armor", os.path.join(temppath, f)])
                 checksums[f] = subprocess.check_output(["sha256sum", "--", f], cwd=temppath).split("  ", 1)[0]
 
-            with DirectoryLock(repository):
+            sign_packages(signkey, packages_macosx, _sign)
+
+            with timed("Repository update"), DirectoryLock(repository):
                 for f in packages_macosx:
                     if os.path.isfile(os.path.join(repository, f)) or \
                        os.path.isfile(os.path.join(repository, "%s.sig" % f)):
@@ -374,9 +655,10 @@ def publish(local_path, repository, signkey):
                             sha, f = line.rstrip().split("  ", 1)
                             if not checksums.has_key(f): checksums[f] = sha
 
-                for f in packages_macosx:
-                    shutil.copy(os.path.join(temppath, f), repository)
-                    shutil.copy(os.path.join(temppath, "%s.sig" % f), repository)
+                with timed("Copying packages"):
+                    for f in packages_macosx:
+                        copy_file(os.path.join(temppath, f), repository)
+                        copy_file(os.path.join(temppath, "%s.sig" % f), repository)
 
                 with open(os.path.join(repository, "SHA256SUMS"), "w") as fp:
                     for f, sha in sorted(checksums.items()):
@@ -389,15 +671,22 @@ def publish(local_path, repository, signkey):
         raise NotImplementedError("Publishing for repository %s not defined" % repository)
 
 
+def parse_destination(destination, signkey):
+    """ Split a 'repository[:signkey]' destination. """
+    m = re.match("^(.*):([0-9A-Fa-f]{8,40})$", destination)
+    if m is not None:
+        return m.group(1), m.group(2)
+    return destination, signkey
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tool to publish packages to a repository")
-    parser.add_argument('--signkey', help="Sign key", default=BUILDER_SIGNKEY)
+    parser.add_argument('--signkey', help="Default sign key", default=BUILDER_SIGNKEY)
     parser.add_argument('source', help="Source directory to process")
-    parser.add_argument('destination', help="Destination repository")
+    parser.add_argument('destination', nargs='+', help="Destination repository, optionally with ':signkey'")
     args = parser.parse_args()
 
     if not os.path.isdir(args.source):
         raise RuntimeError("%s is not a directory" % args.source)
 
-    publish(args.source, args.destination, args.signkey)
+    publish(args.source, [parse_destination(d, args.signkey) for d in args.destination])
     exit(0)
@@ -19,9 +19,14 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
 #
 
-LOG_TTY="/dev/ttyS1"
+LOG_PORT="/dev/virtio-ports/org.winehq.build.0"
 BUILD_USER="builder"
 BUILD_GROUP="builder"
+READY_URL=""
+READY_TIMEOUT="300"
+PROXY_URL=""
+CCACHE_SIZE=""
+BUILD_TREE_STATE=""
 
 # Do not attempt to build twice.
 if [ -f /build/status ]; then
@@ -37,48 +42,180 @@ fi
 
 echo 100    > /build/status
 echo -n ""  > /build/log
+rm -rf /run/build-export /run/build-export.lock
+
+# Messages to the build server are single lines starting with a type:
+# L (log line), S (exit status), P (progress), H (heartbeat), E (phase timing)
+send_message()
+{
+    echo "$1 $2" >&3
+}
+
+# Append to the build log and forward to the build server
+log()
+{
+    tee -a /build/log | sed -u 's/^/L /' >&3
+}
+
+# Record the timing of a phase for the build server
+record_phase()
+{
+    send_message E "$1 $2 $(date +%s.%N)"
+}
+
+# Check once whether the build server answers, never ask the package proxy
+check_ready()
+{
+    if command -v wget >/dev/null 2>&1; then
+        wget -q --no-proxy --timeout=1 --tries=1 -O /dev/null "$READY_URL"
+    else
+        curl -s -f --noproxy '*' --max-time 1 -o /dev/null "$READY_URL"
+    fi
+}
+
+# Download packages through the caching proxy of the build server
+setup_proxy()
+{
+    export http_proxy="$PROXY_URL"
+    if [ -d /etc/apt/apt.conf.d ]; then
+        echo "Acquire::http::Proxy \"$PROXY_URL\";" > /etc/apt/apt.conf.d/99build-proxy
+    fi
+}
+
+# Wait up to READY_TIMEOUT seconds until the build server is reachable
+wait_ready()
+{
+    if ! command -v wget >/dev/null 2>&1 && ! command -v curl >/dev/null 2>&1; then
+        (
+            echo " *** NEITHER WGET NOR CURL FOUND, SKIPPING NETWORK READINESS WAIT ***"
+            echo ""
+        ) | log
+        return 0
+    fi
+
+    local print_once=0
+    local deadline=$(( $(date +%s) + READY_TIMEOUT ))
+    while ! check_ready; do
+        if [ "$(date +%s)" -ge "$deadline" ]; then
+            (
+                echo " *** NETWORK NOT READY AFTER $READY_TIMEOUT SECONDS ***"
+                echo ""
+            ) | log
+            return 1
+        fi
+        if [ "$print_once" -eq 0 ]; then
+            (
+                echo " *** WAITING FOR DHCP SERVER ***"
+                echo ""
+            ) | log
+            print_once=1
+        fi
+        sleep 0.2
+    done
+}
+
+# Wait for the build server, the package proxy is only used if it is reachable
+prepare_network()
+{
+    local server_ready=1
+    if [ -n "$READY_URL" ]; then
+        wait_ready || server_ready=0
+    fi
+    if [ -n "$PROXY_URL" ]; then
+        if [ "$server_ready" -eq 1 ]; then
+            setup_proxy
+        else
+            (
+                echo " *** BUILD SERVER NOT REACHABLE, NOT USING THE PACKAGE PROXY ***"
+                echo ""
+            ) | log
+        fi
+    fi
+}
 
 # Set the language
 export LANG=en_US.utf8
 (echo ""; echo "export LANG=en_US.utf8") >> /etc/profile
 
+# Mount the persistent compiler cache
+if [ -n "$CCACHE_SIZE" ]; then
+    mkdir -p /var/cache/build-ccache
+    if mount LABEL=buildcache /var/cache/build-ccache; then
+        chown "$BUILD_USER:$BUILD_GROUP" /var/cache/build-ccache
+        export CCACHE_DIR="/var/cache/build-ccache"
+        (echo ""; echo "export CCACHE_DIR=$CCACHE_DIR") >> /etc/profile
+        if command -v ccache >/dev/null 2>&1; then
+            su -s /bin/sh -c "ccache -M $CCACHE_SIZE >/dev/null; ccache -z >/dev/null" "$BUILD_USER"
+        fi
+    else
+        CCACHE_SIZE=""
+    fi
+fi
+
+# Mount the persistent build tree, boot.sh can skip most of the work
+# when BUILD_INCREMENTAL=1, BUILD_TREE is empty otherwise
+export BUILD_INCREMENTAL=0
+if [ -n "$BUILD_TREE_STATE" ]; then
+    mkdir -p /var/cache/build-tree
+    if mount LABEL=buildtree /var/cache/build-tree; then
+        chown "$BUILD_USER:$BUILD_GROUP" /var/cache/build-tree
+        export BUILD_TREE="/var/cache/build-tree"
+        if [ "$BUILD_TREE_STATE" == "incremental" ]; then
+            export BUILD_INCREMENTAL=1
+        fi
+    fi
+fi
+
 # Execute the main script
-if [ -e "$LOG_TTY" ]; then
+if [ -e "$LOG_PORT" ]; then
+    exec 3> "$LOG_PORT"
+    ( while sleep 30; do send_message H "$(date +%s)"; done ) &
+    heartbeat_pid="$!"
+
     if [ -x /build/source/boot.sh ]; then
 
-        # Wait for network to come up
-        if command -v wget >/dev/null 2>&1; then
-            print_once=0
-            while ! wget -q --timeout=20 --spider http://google.com; do
-                if [ "$print_once" -eq 0 ]; then
-                    (
-                        echo " *** WAITING FOR DHCP SERVER ***"
-                        echo ""
-                    ) | tee -a /build/log > "$LOG_TTY"
-                    print_once=1
-                fi
-                sleep 10
-            done
-        fi
+        # Wait until the build server is reachable
+        phase_start="$(date +%s.%N)"
+        prepare_network
+        record_phase network "$phase_start"
 
         # Run the boot.sh script
+        send_message P "Running boot.sh"
+        phase_start="$(date +%s.%N)"
         (
             chown "root:$BUILD_GROUP" /build
             chmod g+w /build
             chown -R "$BUILD_USER:$BUILD_GROUP" /build/source
             chmod -R g+w /build/source
             cd /build/source && ./boot.sh
-        )  2>&1 | tee -a /build/log > "$LOG_TTY"
+        )  2>&1 | log
         status="${PIPESTATUS[0]}"
+        record_phase boot.sh "$phase_start"
+        if [ -n "$CCACHE_SIZE" ] && command -v ccache >/dev/null 2>&1; then
+            (
+                echo ""
+                echo " *** COMPILER CACHE STATISTICS ***"
+                su -s /bin/sh -c "ccache -s" "$BUILD_USER"
+            ) 2>&1 | log
+        fi
         if [ "$status" -ne 0 ]; then
             (
                 echo ""
                 echo " *** BUILD FAILED WITH EXITCODE $status ***"
-            ) | tee -a /build/log > "$LOG_TTY"
+            ) | log
         fi
         echo "$status" > /build/status
+        send_message S "$status"
+
+        # Stream all artifacts which were not exported by boot.sh yet
+        phase_start="$(date +%s.%N)"
+        find /build -mindepth 1 -maxdepth 1 -type f -print0 | xargs -0 -r /build/export.sh
+        record_phase export "$phase_start"
 
     fi
+
+    kill "$heartbeat_pid"
+    exec 3>&-
 fi
 
 shutdown -hP now
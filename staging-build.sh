@@ -24,53 +24,33 @@ set -eux
 VERSION="1.9.16"
 RELEASE=""
 
-mkdir -p "repository/raw/macosx-wine-staging"
-repo_path="repository/raw/macosx-wine-staging/$VERSION$RELEASE-x86"
-[ -d "$repo_path" ] && rmdir --ignore-fail-on-non-empty "$repo_path"
-if mkdir "$repo_path"; then
-	./server/build.py --machine "debian-stretch-x64" \
-		--dependencies "repository/raw/macosx-toolchain-2.0.0/deps" \
-		"temp/macosx-wine-staging" "$repo_path"
-fi
+matrix="$(mktemp)"
+trap 'rm -f "$matrix"' EXIT
+
+echo "debian-stretch-x64 temp/macosx-wine-staging" \
+	"repository/raw/macosx-wine-staging/$VERSION$RELEASE-x86" \
+	"repository/raw/macosx-toolchain-2.0.0/deps" >> "$matrix"
 
 for codename in stretch wheezy jessie sid; do
-	mkdir -p "repository/raw/debian-$codename-staging"
 	for arch in x86 x64; do
-
-		repo_path="repository/raw/debian-$codename-staging/$VERSION$RELEASE-$arch"
-		[ -d "$repo_path" ] && rmdir --ignore-fail-on-non-empty "$repo_path"
-		if mkdir "$repo_path"; then
-			./server/build.py --machine "debian-$codename-$arch" \
-				"temp/debian-$codename-staging" "$repo_path"
-		fi
-
+		echo "debian-$codename-$arch temp/debian-$codename-staging" \
+			"repository/raw/debian-$codename-staging/$VERSION$RELEASE-$arch" >> "$matrix"
 	done
 done
 
 for codename in 5 4; do
-	mkdir -p "repository/raw/mageia-$codename-staging"
 	for arch in x86 x64; do
-
-		repo_path="repository/raw/mageia-$codename-staging/$VERSION$RELEASE-$arch"
-		[ -d "$repo_path" ] && rmdir --ignore-fail-on-non-empty "$repo_path"
-		if mkdir "$repo_path"; then
-			./server/build.py --machine "mageia$codename-$arch" \
-				"temp/mageia-any-staging" "$repo_path"
-		fi
-
+		echo "mageia$codename-$arch temp/mageia-any-staging" \
+			"repository/raw/mageia-$codename-staging/$VERSION$RELEASE-$arch" >> "$matrix"
 	done
 done
 
 for codename in 22 23 24; do
-	mkdir -p "repository/raw/fedora-$codename-staging"
 	for arch in x86 x64; do
-
-		repo_path="repository/raw/fedora-$codename-staging/$VERSION$RELEASE-$arch"
-		[ -d "$repo_path" ] && rmdir --ignore-fail-on-non-empty "$repo_path"
-		if mkdir "$repo_path"; then
-			./server/build.py --machine "fedora-$codename-$arch" \
-				"temp/fedora-any-staging" "$repo_path"
-		fi
-
+		echo "fedora-$codename-$arch temp/fedora-any-staging" \
+			"repository/raw/fedora-$codename-staging/$VERSION$RELEASE-$arch" >> "$matrix"
 	done
 done
+
+# Run all builds concurrently, already populated destinations are skipped
+./server/build.py matrix "$matrix"
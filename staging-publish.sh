@@ -25,16 +25,14 @@ VERSION="1.9.16"
 RELEASE=""
 
 repo_path="repository/raw/macosx-wine-staging/$VERSION$RELEASE-x86"
-./server/publish.py "$repo_path" repository/winehq/macosx/i686
-./server/publish.py --signkey 5DC2D5CA "$repo_path" repository/fds-team/macosx/i686
+./server/publish.py "$repo_path" repository/winehq/macosx/i686 repository/fds-team/macosx/i686:5DC2D5CA
 ./server/osx-download-page.py repository/winehq/macosx
 
 for codename in stretch wheezy jessie sid; do
 	for arch in x86 x64; do
 
 		repo_path="repository/raw/debian-$codename-staging/$VERSION$RELEASE-$arch"
-		./server/publish.py "$repo_path" repository/winehq/debian
-		./server/publish.py --signkey 5DC2D5CA "$repo_path" repository/fds-team/debian
+		./server/publish.py "$repo_path" repository/winehq/debian repository/fds-team/debian:5DC2D5CA
 
 	done
 done
@@ -43,8 +41,7 @@ for codename in 5 4; do
 	for arch in x86 x64; do
 
 		repo_path="repository/raw/mageia-$codename-staging/$VERSION$RELEASE-$arch"
-		./server/publish.py "$repo_path" "repository/winehq/mageia/$codename"
-		./server/publish.py --signkey 5DC2D5CA "$repo_path" "repository/fds-team/mageia/$codename"
+		./server/publish.py "$repo_path" "repository/winehq/mageia/$codename" "repository/fds-team/mageia/$codename:5DC2D5CA"
 
 	done
 done
@@ -53,8 +50,7 @@ for codename in 22 23 24; do
 	for arch in x86 x64; do
 
 		repo_path="repository/raw/fedora-$codename-staging/$VERSION$RELEASE-$arch"
-		./server/publish.py "$repo_path" "repository/winehq/fedora/$codename"
-		./server/publish.py --signkey 5DC2D5CA "$repo_path" "repository/fds-team/fedora/$codename"
+		./server/publish.py "$repo_path" "repository/winehq/fedora/$codename" "repository/fds-team/fedora/$codename:5DC2D5CA"
 
 	done
 done
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+# Offline tests for server/build.py, libvirt and the upstream mirrors are
+# replaced by local stand-ins.
+#
+# Copyright (C) 2014-2015 Sebastian Lackner
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+# build.py is python2 only and needs libguestfs, libvirt and lxml
+try:
+    import BaseHTTPServer
+    import urllib2
+    import build
+except (ImportError, SyntaxError):
+    build = None
+
+PACKAGE = "".join(chr(i % 251) for i in range(100000))
+
+class UpstreamHandler(object if build is None else BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PACKAGE)))
+        self.end_headers()
+        # The truncated package announces the full size but closes early
+        if self.path.startswith("/truncated/"):
+            self.wfile.write(PACKAGE[:1000])
+        else:
+            self.wfile.write(PACKAGE)
+
+    def log_message(self, *args):
+        pass
+
+class FakeJob(object):
+    def __init__(self):
+        self.messages = []
+
+    def _guest_ready(self):
+        pass
+
+    def _log_to_file(self, message):
+        self.messages.append(message)
+
+@unittest.skipUnless(build is not None, "build.py needs python2 with guestfs, libvirt and lxml")
+class PackageProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+        self.upstream = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), UpstreamHandler)
+        self.upstream.requests = []
+        thread = threading.Thread(target=self.upstream.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.job = FakeJob()
+        self.cache = build.PackageCache(os.path.join(self.temp, "packages"))
+        self.server = build.JobServer(self.job, "127.0.0.1", self.cache)
+
+    def tearDown(self):
+        self.server.close()
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        shutil.rmtree(self.temp)
+
+    def _get(self, path):
+        """ Download through the proxy like apt in the guest, returns the received data. """
+        url = "http://127.0.0.1:%d%s" % (self.upstream.server_address[1], path)
+        opener = urllib2.build_opener(urllib2.ProxyHandler({ 'http': self.server.url("/") }))
+        response = opener.open(url, timeout=10)
+        data = ""
+        try:
+            while True:
+                chunk = response.read(65536)
+                if chunk == "":
+                    break
+                data += chunk
+        finally:
+            response.close()
+        return url, data
+
+    def _stats(self, **expected):
+        """ The proxy counts after the guest has the data, wait for the server thread. """
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if all(self.cache.stats[k] == v for k, v in expected.items()):
+                break
+            time.sleep(0.01)
+        for k, v in expected.items():
+            self.assertEqual(self.cache.stats[k], v, k)
+
+    def test_miss_and_hit(self):
+        url, data = self._get("/pool/wine_1.0_amd64.deb")
+        self.assertEqual(data, PACKAGE)
+        self._stats(misses=1, miss_bytes=len(PACKAGE))
+
+        with open(self.cache.path(url), "rb") as fp:
+            self.assertEqual(fp.read(), PACKAGE)
+
+        url, data = self._get("/pool/wine_1.0_amd64.deb")
+        self.assertEqual(data, PACKAGE)
+        self._stats(hits=1, hit_bytes=len(PACKAGE))
+        self.assertEqual(len(self.upstream.requests), 1)
+
+    def test_uncached(self):
+        url, data = self._get("/dists/stretch/Release")
+        self.assertEqual(data, PACKAGE)
+        self._stats(uncached=1)
+        self.assertEqual(os.listdir(self.cache.root), [])
+
+    def test_truncated(self):
+        url, data = self._get("/truncated/wine_1.0_amd64.deb")
+        self.assertEqual(len(data), 1000)
+        self._stats(misses=0, uncached=1)
+        self.assertFalse(os.path.exists(self.cache.path(url)))
+        self.assertEqual(os.listdir(self.cache.root), [])
+
+        # The next request goes to the upstream server again
+        self._get("/truncated/wine_1.0_amd64.deb")
+        self.assertEqual(len(self.upstream.requests), 2)
+
+@unittest.skipUnless(build is not None, "build.py needs python2 with guestfs, libvirt and lxml")
+class BlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.store = build.BlobStore(os.path.join(self.temp, "store"))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_deduplicate(self):
+        for name in ["a", "b"]:
+            with open(os.path.join(self.temp, name), "wb") as fp:
+                fp.write("content")
+        self.assertTrue(self.store.usable(self.temp))
+        for name in ["a", "b"]:
+            self.store.add(os.path.join(self.temp, name), "ab" * 32)
+        self.assertEqual(os.stat(os.path.join(self.temp, "a")).st_nlink, 3)
+        self.assertEqual(self.store.gc(), (0, 0))
+
+        os.unlink(os.path.join(self.temp, "a"))
+        os.unlink(os.path.join(self.temp, "b"))
+        self.assertEqual(self.store.gc(), (1, len("content")))
+
+    def test_other_file_system(self):
+        other = "/dev/shm"
+        if not os.path.isdir(other) or os.stat(other).st_dev == os.stat(self.temp).st_dev:
+            self.skipTest("no second file system available")
+        self.assertFalse(self.store.usable(other))
+
+class FakeDomain(object):
+    def __init__(self, conn, name, xml):
+        self.conn   = conn
+        self.xml    = xml
+        self.state  = None if build is None else build.libvirt.VIR_DOMAIN_SHUTOFF
+        self._name  = name
+
+    def name(self):
+        return self._name
+
+    def XMLDesc(self, flags):
+        return self.xml
+
+    def info(self):
+        return [self.state, 0, 0, 1, 0]
+
+    def create(self):
+        self.state = build.libvirt.VIR_DOMAIN_RUNNING
+
+    def destroy(self):
+        if self.state != build.libvirt.VIR_DOMAIN_RUNNING:
+            raise build.libvirt.libvirtError("domain is not running")
+        self.state = build.libvirt.VIR_DOMAIN_SHUTOFF
+        self.conn.emit(self, build.libvirt.VIR_DOMAIN_EVENT_STOPPED)
+
+    def undefine(self):
+        del self.conn.domains[self._name]
+
+class FakeConnection(object):
+    def __init__(self):
+        """ Stand-in for a libvirt connection, events are delivered synchronously. """
+        self.domains    = {}
+        self.callbacks  = []
+
+    def registerCloseCallback(self, callback, opaque):
+        pass
+
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+        self.callbacks.append(callback)
+
+    def emit(self, dom, event):
+        for callback in self.callbacks:
+            callback(self, dom, event, 0, None)
+
+    def defineXML(self, xml):
+        name = build.etree.fromstring(xml).xpath("/domain/name")[0].text
+        self.domains[name] = FakeDomain(self, name, xml)
+        return self.domains[name]
+
+    def lookupByName(self, name):
+        if not name in self.domains:
+            raise build.libvirt.libvirtError("domain %s not found" % name)
+        return self.domains[name]
+
+@unittest.skipUnless(build is not None, "build.py needs python2 with guestfs, libvirt and lxml")
+class HypervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeConnection()
+        build.set_hypervisor(build.Hypervisor(conn=self.conn))
+
+    def tearDown(self):
+        build.set_hypervisor(None)
+
+    def test_domain_lifecycle(self):
+        hv = build.hypervisor()
+        self.assertEqual(hv.define("<domain><name>build-test</name></domain>"), "build-test")
+        self.assertEqual(hv.state("build-test"), build.libvirt.VIR_DOMAIN_SHUTOFF)
+
+        hv.start("build-test")
+        self.assertEqual(hv.state("build-test"), build.libvirt.VIR_DOMAIN_RUNNING)
+
+        # The watcher is woken up by the lifecycle event of the fake connection
+        stopped = []
+        thread = threading.Thread(target=lambda: stopped.append(build.domain_watcher().wait("build-test", 10)))
+        thread.start()
+        while not "build-test" in build.domain_watcher().watched:
+            time.sleep(0.01)
+        self.assertTrue(hv.destroy("build-test"))
+        thread.join()
+        self.assertEqual(stopped, [True])
+
+        self.assertFalse(hv.destroy("build-test"))
+        hv.undefine("build-test")
+        self.assertEqual(hv.state("build-test"), None)
+
+    def test_domain_xml(self):
+        self.conn.defineXML("<domain><name>debian-stretch-x64</name></domain>")
+        tree = build.domain_xml("debian-stretch-x64")
+        tree.xpath("/domain/name")[0].text = "modified"
+        self.assertEqual(build.domain_xml("debian-stretch-x64").xpath("/domain/name")[0].text,
+                         "debian-stretch-x64")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Offline tests for publishing with server/publish.py.
+#
+# Copyright (C) 2014-2015 Sebastian Lackner
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+PUBLISH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server", "publish.py")
+PYTHON2 = os.environ.get("PYTHON2", "python2")
+SIGNKEY = "5DC2D5CA"
+
+# Every fake tool records its arguments, one call per line separated by tabs
+FAKE_TOOL = """#!/bin/bash
+(IFS=$'\\t'; echo "$*") >> "%(calls)s/$(basename "$0")"
+%(body)s
+exit 0
+"""
+
+FAKE_BODIES = {
+    'gpg': """
+if [ "$1" == "--with-fingerprint" ]; then
+    echo "pub   4096R/%(signkey)s 2016-01-01 Test Key <test@example.com>"
+    echo "      Key fingerprint = 0000 0000 0000 0000 0000  0000 0000 0000 %(signkey)s"
+elif [[ " $* " == *" --detach-sign "* ]] && [[ " $* " != *" --output "* ]]; then
+    file="${@: -1}"
+    if [[ " $* " == *" --armor "* ]]; then
+        echo "signature" > "$file.asc"
+    else
+        echo "signature" > "$file.sig"
+    fi
+fi
+""",
+    'rpm': "",
+    'gpg-connect-agent': """
+exit ${FAKE_AGENT_STATUS:-0}
+""",
+    'createrepo': """
+repository="${@: -1}"
+mkdir -p "$repository/repodata"
+echo "<repomd/>" > "$repository/repodata/repomd.xml"
+""",
+}
+
+def python2_available():
+    try:
+        return subprocess.call([PYTHON2, "-c", "import sys; sys.exit(sys.version_info[0] != 2)"]) == 0
+    except OSError:
+        return False
+
+@unittest.skipUnless(python2_available(), "publish.py needs python2, set PYTHON2")
+class PublishTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+        # publish.py expects its tools next to it and some files in $HOME
+        self.server = os.path.join(self.temp, "server")
+        for d in ["tools/bin", "tools/lib/x86_64-linux-gnu/perl5/5.20", "tools/share/perl5"]:
+            os.makedirs(os.path.join(self.server, d))
+        shutil.copy(PUBLISH, self.server)
+
+        self.home = os.path.join(self.temp, "home")
+        os.makedirs(os.path.join(self.home, ".config"))
+        for f in [".rpmmacros", ".config/wine-osx-key.pem"]:
+            open(os.path.join(self.home, f), "w").close()
+
+        self.calls = os.path.join(self.temp, "calls")
+        self.bin = os.path.join(self.temp, "bin")
+        os.mkdir(self.calls)
+        os.mkdir(self.bin)
+        for name, body in FAKE_BODIES.items():
+            path = os.path.join(self.bin, name)
+            with open(path, "w") as fp:
+                fp.write(FAKE_TOOL % { 'calls': self.calls, 'body': body % { 'signkey': SIGNKEY } })
+            os.chmod(path, 0o755)
+
+        self.root = os.path.join(self.temp, "repository")
+        self.repository = os.path.join(self.root, "fedora/25")
+        os.makedirs(self.repository)
+        open(os.path.join(self.root, "Release.key"), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def _publish(self, packages, repository=None, agent=True):
+        source = tempfile.mkdtemp(dir=self.temp)
+        with open(os.path.join(source, "status"), "w") as fp:
+            fp.write("0\n")
+        for f in packages:
+            open(os.path.join(source, f), "w").close()
+
+        env = dict(os.environ)
+        env["HOME"] = self.home
+        env["PATH"] = "%s:%s" % (self.bin, env.get("PATH", ""))
+        env.pop("GPG_AGENT_INFO", None)
+        env["FAKE_AGENT_STATUS"] = "0" if agent else "1"
+        process = subprocess.Popen([PYTHON2, os.path.join(self.server, "publish.py"), source,
+                                    "%s:%s" % (repository or self.repository, SIGNKEY)], env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode("utf-8")
+        self.assertEqual(process.returncode, 0, output)
+        return output
+
+    def _calls(self, tool):
+        with open(os.path.join(self.calls, tool)) as fp:
+            return [line.rstrip("\n").split("\t") for line in fp]
+
+    def test_createrepo(self):
+        self._publish(["wine-1.0-1.x86_64.rpm"])
+        self._publish(["wine-1.1-1.i686.rpm", "wine-1.1-1.x86_64.rpm"])
+
+        cachedir = os.path.join(self.server, "metadata-cache",
+                                hashlib.md5(os.path.abspath(self.repository).encode("utf-8")).hexdigest())
+        calls = self._calls("createrepo")
+        self.assertEqual(len(calls), 2)
+        for call in calls:
+            self.assertEqual(len(call), 4)
+            self.assertEqual(call[:2], ["--update", "--cachedir"])
+            self.assertEqual(os.path.normpath(call[2]), cachedir)
+            self.assertEqual(call[3], self.repository)
+
+        # The cache survives between runs and is not part of the published tree
+        self.assertTrue(os.path.isdir(cachedir))
+        self.assertFalse(cachedir.startswith(self.root + os.sep))
+
+        for d, f in [("x86_64", "wine-1.0-1.x86_64.rpm"), ("i686", "wine-1.1-1.i686.rpm"),
+                     ("x86_64", "wine-1.1-1.x86_64.rpm")]:
+            self.assertTrue(os.path.isfile(os.path.join(self.repository, d, f)))
+
+        signed = [c for c in self._calls("gpg") if "--detach-sign" in c]
+        self.assertEqual(signed[-1][-1], os.path.join(self.repository, "repodata/repomd.xml"))
+
+    def _seed(self, count):
+        """ Fill the repository with packages and metadata of earlier publishes. """
+        for d in ["i686", "x86_64"]:
+            try:
+                os.makedirs(os.path.join(self.repository, d))
+            except OSError:
+                pass
+            for i in range(count):
+                open(os.path.join(self.repository, d, "old-1.%d-1.%s.rpm" % (i, d)), "w").close()
+        try:
+            os.makedirs(os.path.join(self.repository, "repodata"))
+        except OSError:
+            pass
+        with open(os.path.join(self.repository, "repodata/repomd.xml"), "w") as fp:
+            fp.write("<repomd/>")
+
+    def _snapshot(self):
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(self.repository):
+            for f in filenames:
+                st = os.stat(os.path.join(dirpath, f))
+                result[os.path.join(dirpath, f)] = (st.st_ino, st.st_mtime)
+        return result
+
+    def _work(self, existing):
+        """ Publish two packages into a fresh repository with existing packages,
+            returns the tool calls and the repository files written. """
+        self.tearDown()
+        self.setUp()
+        self._seed(existing)
+        before = self._snapshot()
+        self._publish(["wine-2.0-1.i686.rpm", "wine-2.0-1.x86_64.rpm"])
+        after = self._snapshot()
+
+        written = sorted(os.path.relpath(f, self.repository) for f, v in after.items()
+                         if before.get(f) != v and not f.startswith(os.path.join(self.repository, "repodata")))
+        calls = dict((tool, self._calls(tool)) for tool in ["rpm", "createrepo"])
+        calls['gpg'] = [c for c in self._calls("gpg") if "--detach-sign" in c]
+        return calls, written
+
+    def test_flat_publish_work(self):
+        """ The work publish.py does itself must not grow with the size of the repository:
+            only the new packages are signed and copied, existing files are left alone and
+            createrepo is always asked for an incremental --update. The fake createrepo
+            cannot show that createrepo itself only reads new packages, that relies on
+            --update together with the persistent --cachedir checked in test_createrepo. """
+        small_calls, small_written = self._work(0)
+        large_calls, large_written = self._work(500)
+
+        self.assertEqual(len(small_calls['rpm']), 2)
+        self.assertEqual(len(large_calls['rpm']), 2)
+        self.assertEqual(len(small_calls['gpg']), len(large_calls['gpg']))
+        self.assertEqual(len(large_calls['createrepo']), 1)
+        self.assertEqual(large_calls['createrepo'][0][0], "--update")
+
+        self.assertEqual(small_written, ["i686/wine-2.0-1.i686.rpm", "x86_64/wine-2.0-1.x86_64.rpm"])
+        self.assertEqual(large_written, small_written)
+
+    def test_sign_with_agent(self):
+        output = self._publish(["wine-1.0-1.i686.rpm", "wine-1.0-1.x86_64.rpm"])
+        self.assertNotIn("signing packages one at a time", output)
+
+        # The passphrase is cached once before the workers start
+        preload = [c for c in self._calls("gpg") if "/dev/null" in c]
+        self.assertEqual(len(preload), 1)
+        self.assertIn("--use-agent", preload[0])
+
+    def test_sign_without_agent(self):
+        output = self._publish(["wine-1.0-1.i686.rpm", "wine-1.0-1.x86_64.rpm"], agent=False)
+        self.assertIn("No gpg-agent available, signing packages one at a time", output)
+        self.assertEqual([c for c in self._calls("gpg") if "/dev/null" in c], [])
+        self.assertEqual(len(self._calls("rpm")), 2)
+
+    def test_macosx_new_repository(self):
+        # Release.key is shared, the repository directory does not exist yet
+        repository = os.path.join(self.root, "macosx/i686")
+        self._publish(["portable-winehq-staging-2.0-osx64.tar.gz"], repository)
+
+        self.assertTrue(os.path.isfile(os.path.join(repository, "portable-winehq-staging-2.0-osx64.tar.gz")))
+        with open(os.path.join(repository, "SHA256SUMS")) as fp:
+            self.assertIn("portable-winehq-staging-2.0-osx64.tar.gz", fp.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Offline tests for the readiness wait in server/wrapper.sh.
+#
+# Copyright (C) 2014-2015 Sebastian Lackner
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+WRAPPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server", "wrapper.sh")
+
+def wrapper_functions(*names):
+    """ Extract shell functions from wrapper.sh without running the script. """
+    with open(WRAPPER) as fp:
+        script = fp.read()
+    result = []
+    for name in names:
+        m = re.search("^%s\\(\\)\n\\{\n.*?^\\}\n" % name, script, re.MULTILINE | re.DOTALL)
+        assert m is not None, "function %s not found" % name
+        result.append(m.group(0))
+    return "\n".join(result)
+
+def which(name):
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        if os.access(os.path.join(path, name), os.X_OK):
+            return os.path.join(path, name)
+    return None
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class ReadyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200 if self.path == "/ready" else 404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class LateServer(object):
+    def __init__(self, port, delay):
+        """ Dummy build server which only starts listening after a delay. """
+        self.port   = port
+        self.server = None
+        self.timer  = threading.Timer(delay, self._start)
+        self.timer.start()
+
+    def _start(self):
+        self.server = HTTPServer(("127.0.0.1", self.port), ReadyHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.timer.cancel()
+        self.timer.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+class WaitReadyTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def _wait_ready(self, port, timeout, path=None, command="wait_ready", proxy_url=None):
+        """ Run wait_ready from wrapper.sh, returns exit status, log and duration. """
+        script = "log()\n{\n    cat\n}\n\n%s\n%s\n" % (wrapper_functions("check_ready", "wait_ready", "prepare_network"), command)
+        env = dict(os.environ)
+        env["READY_URL"]     = "http://127.0.0.1:%d/ready" % port
+        env["READY_TIMEOUT"] = str(timeout)
+        # The readiness probe must bypass the package proxy
+        env["http_proxy"]    = "http://127.0.0.1:%d/" % free_port()
+        if path is not None:
+            env["PATH"] = path
+        if proxy_url is not None:
+            env["PROXY_URL"] = proxy_url
+
+        start = time.time()
+        process = subprocess.Popen([which("bash"), "-c", script], env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode("utf-8")
+        return process.returncode, output, time.time() - start
+
+    def _tool_path(self, tool=None):
+        """ PATH with the basic utilities and only one of wget / curl. """
+        path = os.path.join(self.temp, tool or "none")
+        os.mkdir(path)
+        for name in ["date", "sleep", "cat"] + ([tool] if tool else []):
+            target = which(name)
+            if target is None:
+                self.skipTest("%s is not installed" % name)
+            os.symlink(target, os.path.join(path, name))
+        return path
+
+    def _check_late_server(self, tool):
+        port = free_port()
+        server = LateServer(port, 1.5)
+        try:
+            status, output, duration = self._wait_ready(port, 20, self._tool_path(tool))
+        finally:
+            server.close()
+        self.assertEqual(status, 0, output)
+        self.assertGreaterEqual(duration, 1.5)
+        self.assertEqual(output.count("WAITING FOR DHCP SERVER"), 1)
+        self.assertNotIn("NOT READY", output)
+
+    def test_late_server_wget(self):
+        self._check_late_server("wget")
+
+    def test_late_server_curl(self):
+        self._check_late_server("curl")
+
+    def test_no_tool(self):
+        status, output, duration = self._wait_ready(free_port(), 20, self._tool_path())
+        self.assertEqual(status, 0, output)
+        self.assertLess(duration, 5)
+        self.assertIn("SKIPPING NETWORK READINESS WAIT", output)
+
+    def test_timeout(self):
+        status, output, duration = self._wait_ready(free_port(), 2)
+        self.assertNotEqual(status, 0)
+        self.assertIn("NETWORK NOT READY AFTER 2 SECONDS", output)
+
+    def _prepare_network(self, port, timeout):
+        """ Run prepare_network, setup_proxy is replaced to keep the apt config untouched. """
+        command = "setup_proxy()\n{\n    echo \"PROXY $PROXY_URL\"\n}\nprepare_network\n"
+        return self._wait_ready(port, timeout, command=command, proxy_url="http://127.0.0.1:%d/" % port)
+
+    def test_proxy_after_ready(self):
+        port = free_port()
+        server = LateServer(port, 0.5)
+        try:
+            status, output, duration = self._prepare_network(port, 20)
+        finally:
+            server.close()
+        self.assertEqual(status, 0, output)
+        self.assertIn("PROXY http://127.0.0.1:%d/" % port, output)
+
+    def test_no_proxy_after_timeout(self):
+        status, output, duration = self._prepare_network(free_port(), 2)
+        self.assertIn("NETWORK NOT READY AFTER 2 SECONDS", output)
+        self.assertIn("NOT USING THE PACKAGE PROXY", output)
+        self.assertNotIn("PROXY http://", output)
+
+if __name__ == '__main__':
+    unittest.main()